@@ -3,24 +3,41 @@ from flask import Flask, jsonify
 from flask_smorest import Api
 from flask_jwt_extended import JWTManager
 from flask_migrate import Migrate
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import redis
 
 from dotenv import load_dotenv
-from rq import Queue
 
 from db import db
 import models
 from blocklist import BLOCKLIST
+from coalesce import SingleFlight
+from profiler import Profiler
+from memory import MemoryMonitor
+from snapshot import CatalogSnapshot
+from startup import StartupTimer
+from online_migrations import online_cli
+from ratelimit import RateLimiter
+from sharding import init_sharding
+from tagbitmaps import TagBitmaps
+from jobs import JobQueues, jobs_cli
 
 from resources.item import blp as ItemBlueprint
 from resources.store import blp as StoreBlueprint
 from resources.tag import blp as TagBlueprint
 from resources.user import blp as UserBlueprint
+from resources.metrics import blp as MetricsBlueprint
+from resources.batch import blp as BatchBlueprint
+from resources.profiler import blp as ProfilerBlueprint
+from resources.memory import blp as MemoryBlueprint
 
 # Define the app with various config settings and pointers to files within this directory
 def create_app(db_url=None):
     app = Flask(__name__)
+    # Time each phase of app creation, reported by boot.py / gunicorn.conf.py (see startup.py)
+    timer = StartupTimer()
+    app.startup_timer = timer
 
     # Load environment file to allow for loading of postgresql database url
     load_dotenv()
@@ -29,7 +46,31 @@ def create_app(db_url=None):
     connection = redis.from_url(
         os.getenv("REDIS_URL")
     )
-    app.queue = Queue("emails", connection=connection)
+    # One RQ queue per entry in settings.QUEUES, with dedup keys, delayed jobs and metrics (see jobs.py)
+    app.jobs = JobQueues(connection)
+    app.queue = app.jobs.queue("emails")
+    # "flask jobs worker" starts the worker pool, "flask jobs stats" prints the queue metrics
+    app.cli.add_command(jobs_cli)
+    # Keep the connection on the app so other parts of the app can reuse it
+    app.redis = connection
+
+    # Share one computation between identical concurrent reads of hot keys in a worker's threads
+    # (GUNICORN_THREADS in gunicorn.conf.py, see coalesce.py)
+    # COALESCE_REDIS=1 also coalesces across gunicorn workers through redis
+    app.coalescer = SingleFlight(
+        connection if os.getenv("COALESCE_REDIS") == "1" else None,
+        ttl=float(os.getenv("COALESCE_TTL", "0")),
+    )
+
+    # Per-tag item bitmaps for GET /store/<id>/items?tags=...&exclude=... (see tagbitmaps.py)
+    # Workers notice each other's writes through redis, TAG_BITMAPS_MAX_AGE is the fallback without it
+    # TAG_BITMAPS_MAX_STORES bounds how many stores' bitmaps a worker keeps
+    app.tag_bitmaps = TagBitmaps(
+        connection,
+        max_age=float(os.getenv("TAG_BITMAPS_MAX_AGE", "5")),
+        max_stores=int(os.getenv("TAG_BITMAPS_MAX_STORES", "1000")),
+    )
+    timer.mark("redis, queue and coalescing")
 
     # App Settings
     # Hidden exceptions in flask should be brought into main app
@@ -61,11 +102,26 @@ def create_app(db_url=None):
     # Extra sqlalchemy settings
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+    timer.mark("config")
+
+    # Optional sharding of store data across several databases (see sharding.py)
+    # SHARD_DATABASE_URLS lists the extra databases, the main database above is shard 0
+    if os.getenv("SHARD_DATABASE_URLS"):
+        app.shard_router = init_sharding(
+            app,
+            os.getenv("SHARD_DATABASE_URLS").split(","),
+            connection,
+            shard_map=os.getenv("SHARD_MAP"),
+        )
+
     # Initialize flask sqlalchemy extension
     db.init_app(app)
 
     # Add migration
     migrate = Migrate(app,db)
+    # "flask online ..." commands for migrating large tables (see online_migrations.py)
+    app.cli.add_command(online_cli)
+    timer.mark("database and migrations")
 
     # Link smorest to app
     api = Api(app)
@@ -144,16 +200,51 @@ def create_app(db_url=None):
             ),
             401,
         )
+    timer.mark("api and jwt")
 
     # Now handled by flask-migrate
     # # Create tables if they do not exist in the database
     # with app.app_context():
     #     db.create_all()
 
+    # Optional shared catalog snapshot, serves the store/item/tag GET endpoints from a memory-mapped file
+    # CATALOG_SNAPSHOT is the file path, CATALOG_SNAPSHOT_INTERVAL optionally rebuilds it every N seconds
+    # After a write, reads see it within CATALOG_SNAPSHOT_MAX_DELAY seconds even during a steady stream of writes
+    app.catalog = None
+    if os.getenv("CATALOG_SNAPSHOT"):
+        app.catalog = CatalogSnapshot(
+            app,
+            os.getenv("CATALOG_SNAPSHOT"),
+            interval=float(os.getenv("CATALOG_SNAPSHOT_INTERVAL", "0")),
+            max_delay=float(os.getenv("CATALOG_SNAPSHOT_MAX_DELAY", "2")),
+        )
+
+    # On-demand profiler, only wraps the app while an admin has a session running (see profiler.py)
+    app.profiler = Profiler(app)
+
+    # Per worker memory gauges, per route memory stats and tracemalloc diffs (see memory.py)
+    # MEMORY_TRACE=1 starts tracemalloc with the app, otherwise an admin starts it with POST /memory/tracemalloc
+    app.memory = MemoryMonitor(app, connection)
+
+    # Load shedding and per-user / per-IP rate limits (see ratelimit.py)
+    app.rate_limiter = RateLimiter(app, connection)
+    # Number of proxies in front of the app whose X-Forwarded-For can be trusted (0 trusts none)
+    # Without it request.remote_addr, used to key rate limits by IP, is the address of the last proxy
+    app.trusted_proxies = int(os.getenv("PROXY_FIX_X_FOR", "0"))
+    if app.trusted_proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.trusted_proxies)
+
+    timer.mark("catalog snapshot, profiler, memory and rate limits")
+
     # Register blueprints in resources so that they will be used by the API
     api.register_blueprint(ItemBlueprint)
     api.register_blueprint(StoreBlueprint)
     api.register_blueprint(TagBlueprint)
     api.register_blueprint(UserBlueprint)
+    api.register_blueprint(MetricsBlueprint)
+    api.register_blueprint(BatchBlueprint)
+    api.register_blueprint(ProfilerBlueprint)
+    api.register_blueprint(MemoryBlueprint)
+    timer.mark("blueprints")
 
     return app
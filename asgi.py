@@ -0,0 +1,291 @@
+"""
+asgi.py
+
+Alternative ASGI entry point for the API. GET requests for items, stores and tags are
+served directly on asyncio using an async SQLAlchemy engine, so a request waiting on the
+database (or on a slow client) no longer holds a whole worker. Every other request
+(writes, users, swagger docs) is handed to the normal Flask app from app.py, which runs
+in a thread pool.
+
+The read routes answered here go through the same load shedding and rate limits as the flask app
+(the RateLimiter from ratelimit.py), since the flask request hooks never see them.
+
+Run with:
+    uvicorn "asgi:create_asgi_app" --factory --host 0.0.0.0 --port 80
+or through gunicorn with SERVER_MODE=asgi (see docker-entrypoint.sh)
+"""
+
+import asyncio
+import json
+import os
+import re
+import signal
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from asgiref.wsgi import WsgiToAsgi
+from dotenv import load_dotenv
+from flask_jwt_extended import decode_token
+from jwt.exceptions import ExpiredSignatureError, PyJWTError
+from flask_jwt_extended.exceptions import JWTExtendedException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from app import create_app
+from blocklist import BLOCKLIST
+from db import db
+from memory import current_rss
+from models import ItemModel, StoreModel, TagModel
+from ratelimit import OVERLOADED, RATE_LIMITED, forwarded_address
+from schemas import ItemSchema, StoreSchema, TagSchema
+
+
+# Swap the sync driver in a database url for its asyncio equivalent
+# sqlite:///data.db -> sqlite+aiosqlite:///data.db, postgres://... -> postgresql+asyncpg://...
+def to_async_url(db_url):
+    if db_url.startswith("sqlite:"):
+        return db_url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if db_url.startswith("postgres://"):
+        return db_url.replace("postgres://", "postgresql+asyncpg://", 1)
+    if db_url.startswith("postgresql://") or db_url.startswith("postgresql+psycopg2://"):
+        return "postgresql+asyncpg://" + db_url.split("://", 1)[1]
+    return db_url
+
+
+# Loaders run inside AsyncSession.run_sync, so the existing models (including the lazy="dynamic"
+# relationships on StoreModel) and the marshmallow schemas can be reused unchanged
+def load_item(session, item_id):
+    item = session.get(ItemModel, item_id)
+    return item and ItemSchema().dump(item)
+
+def load_items(session):
+    return ItemSchema(many=True).dump(session.scalars(select(ItemModel)).all())
+
+def load_store(session, store_id):
+    store = session.get(StoreModel, store_id)
+    return store and StoreSchema().dump(store)
+
+def load_stores(session):
+    return StoreSchema(many=True).dump(session.scalars(select(StoreModel)).all())
+
+def load_tags_in_store(session, store_id):
+    store = session.get(StoreModel, store_id)
+    return store and TagSchema(many=True).dump(store.tags.all())
+
+def load_tag(session, tag_id):
+    tag = session.get(TagModel, tag_id)
+    return tag and TagSchema().dump(tag)
+
+
+# (path regex, loader, jwt required, blueprint) - mirrors the GET routes in resources/
+# The blueprint name picks the rate limit budget, like request.blueprint does in the flask app
+READ_ROUTES = [
+    (re.compile(r"^/item/(\d+)$"), load_item, True, "items"),
+    (re.compile(r"^/item$"), load_items, True, "items"),
+    (re.compile(r"^/store/(\d+)$"), load_store, False, "stores"),
+    (re.compile(r"^/store$"), load_stores, False, "stores"),
+    (re.compile(r"^/store/(\d+)/tag$"), load_tags_in_store, False, "tags"),
+    (re.compile(r"^/tags/(\d+)$"), load_tag, False, "tags"),
+]
+
+# Error bodies match the ones registered on the JWTManager in app.py
+MISSING_TOKEN = {"description": "Request does not contain an access token.", "error": "authorization_required"}
+INVALID_TOKEN = {"message": "Signature verification failed.", "error": "invalid_token"}
+EXPIRED_TOKEN = {"message": "The token has expired.", "error": "token_expired"}
+REVOKED_TOKEN = {"description": "The token has been revoked.", "error": "token_revoked"}
+NOT_FOUND = {"code": 404, "status": "Not Found"}
+
+# Bumped after every write handled by the flask app, cached reads are keyed on it so a write makes them unreachable
+CACHE_GENERATION_KEY = "asgi:generation"
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+class AsyncReadApp:
+    def __init__(self, flask_app, db_url, redis_url=None, cache_ttl=0, max_rss=0):
+        self.flask_app = flask_app
+        # Anything that is not a read route falls back to the sync app
+        self.fallback = WsgiToAsgi(flask_app)
+
+        # sqlite does not use a sized connection pool, so only pass pool settings for other databases
+        pool_options = {} if db_url.startswith("sqlite") else {
+            "pool_size": int(os.getenv("ASGI_DB_POOL_SIZE", "10")),
+            "max_overflow": int(os.getenv("ASGI_DB_MAX_OVERFLOW", "20")),
+        }
+        self.engine = create_async_engine(to_async_url(db_url), **pool_options)
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+
+        # Optional response cache for the read routes, 0 disables it
+        # Any write that goes through the flask app invalidates everything cached so far
+        self.cache_ttl = cache_ttl
+        self.redis = aioredis.from_url(redis_url) if redis_url and cache_ttl else None
+
+        # RSS in bytes above which the worker recycles itself, 0 disables it
+        # The uvicorn worker never calls gunicorn's post_request hook, so the check happens here
+        self.max_rss = max_rss
+        self.recycling = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(scope, receive, send)
+        try:
+            await self.handle(scope, receive, send)
+        finally:
+            if scope["type"] == "http":
+                self.check_rss()
+
+    async def handle(self, scope, receive, send):
+        # Requests with a query string (e.g. the ?ids= multi-get) are left to the flask app
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD") and not scope.get("query_string"):
+            for pattern, loader, needs_jwt, blueprint in READ_ROUTES:
+                match = pattern.match(scope["path"])
+                if match:
+                    return await self.read(scope, send, loader, match.groups(), needs_jwt, blueprint)
+
+        await self.fallback(scope, receive, send)
+        if self.redis is not None and scope["type"] == "http" and scope["method"] in WRITE_METHODS:
+            await self.bump_cache_generation()
+
+    # Same threshold as post_request in gunicorn.conf.py. SIGTERM makes the uvicorn worker finish its
+    # in-flight requests and exit, and the gunicorn master starts a fresh one
+    def check_rss(self):
+        if not self.max_rss or self.recycling:
+            return
+        rss = current_rss()
+        if rss > self.max_rss:
+            self.flask_app.logger.info(f"Worker {os.getpid()} RSS is {rss // (1024 * 1024)}MB, above WORKER_MAX_RSS_MB, recycling it.")
+            self.recycling = True
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    async def lifespan(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                if self.redis is not None:
+                    await self.redis.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def read(self, scope, send, loader, args, needs_jwt, blueprint):
+        limiter = self.flask_app.rate_limiter
+        limiter.enter()
+        try:
+            return await self.admit_and_read(scope, send, loader, args, needs_jwt, blueprint)
+        finally:
+            limiter.leave()
+
+    # Same order as the flask app: load shedding and rate limits first, then the JWT check of the view
+    async def admit_and_read(self, scope, send, loader, args, needs_jwt, blueprint):
+        limiter = self.flask_app.rate_limiter
+        error, identity = self.check_jwt(scope)
+        if limiter.overloaded(self.engine.pool):
+            return await self.respond(send, 503, OVERLOADED, retry_after=1)
+        if limiter.enabled:
+            client = f"user:{identity}" if identity is not None else f"ip:{self.client_address(scope)}"
+            # The buckets live in redis behind a blocking client, keep it off the event loop
+            retry_after = await asyncio.to_thread(limiter.limit, blueprint, client)
+            if retry_after is not None:
+                return await self.respond(send, 429, RATE_LIMITED, retry_after=max(1, retry_after))
+
+        if needs_jwt and error:
+            return await self.respond(send, 401, error)
+
+        cache_key = None
+        if self.redis is not None:
+            try:
+                generation = int(await self.redis.get(CACHE_GENERATION_KEY) or 0)
+                cache_key = f"asgi:{generation}:{scope['path']}"
+                cached = await self.redis.get(cache_key)
+                if cached is not None:
+                    return await self.respond_raw(send, 200, cached)
+            except RedisError:
+                # Serve uncached while redis is unreachable
+                cache_key = None
+
+        async with self.sessionmaker() as session:
+            data = await session.run_sync(loader, *(int(arg) for arg in args))
+
+        if data is None:
+            return await self.respond(send, 404, NOT_FOUND)
+
+        body = json.dumps(data).encode()
+        if cache_key is not None:
+            try:
+                await self.redis.set(cache_key, body, ex=self.cache_ttl)
+            except RedisError:
+                pass
+        return await self.respond_raw(send, 200, body)
+
+    # A read cached before this write was computed under the old generation and is never served again
+    async def bump_cache_generation(self):
+        try:
+            await self.redis.incr(CACHE_GENERATION_KEY)
+        except RedisError:
+            pass
+
+    # Same checks as @jwt_required(): bearer access token, valid signature, not expired, not blocklisted
+    # Returns (error body, None) or (None, identity)
+    # Only decoding needs the flask app context, no database work is done here
+    def check_jwt(self, scope):
+        header = dict(scope["headers"]).get(b"authorization", b"").decode()
+        if not header.startswith("Bearer "):
+            return MISSING_TOKEN, None
+        try:
+            with self.flask_app.app_context():
+                payload = decode_token(header[len("Bearer "):])
+        except ExpiredSignatureError:
+            return EXPIRED_TOKEN, None
+        except (PyJWTError, JWTExtendedException):
+            return INVALID_TOKEN, None
+        if payload.get("type") != "access":
+            return INVALID_TOKEN, None
+        if payload["jti"] in BLOCKLIST:
+            return REVOKED_TOKEN, None
+        return None, payload["sub"]
+
+    # Same address the flask app sees as request.remote_addr, with ProxyFix applied when PROXY_FIX_X_FOR is set
+    def client_address(self, scope):
+        remote_addr = scope["client"][0] if scope.get("client") else None
+        forwarded_for = dict(scope["headers"]).get(b"x-forwarded-for", b"").decode()
+        return forwarded_address(remote_addr, forwarded_for, self.flask_app.trusted_proxies)
+
+    async def respond(self, send, status, data, retry_after=None):
+        return await self.respond_raw(send, status, json.dumps(data).encode(), retry_after)
+
+    async def respond_raw(self, send, status, body, retry_after=None):
+        headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ]
+        if retry_after is not None:
+            headers.append((b"retry-after", str(retry_after).encode()))
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers,
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+# Factory used by uvicorn / gunicorn, same arguments as create_app in app.py
+def create_asgi_app(db_url=None):
+    load_dotenv()
+    db_url = db_url or os.getenv("DATABASE_URL", "sqlite:///data.db")
+    flask_app = create_app(db_url)
+    # The read path queries the main database directly, with sharding it would miss the other shards' rows
+    if hasattr(flask_app, "shard_router"):
+        raise RuntimeError("SERVER_MODE=asgi does not support sharding, unset SHARD_DATABASE_URLS or use SERVER_MODE=wsgi")
+
+    # Use the url flask-sqlalchemy resolved, so relative sqlite paths point at the same file (instance/data.db)
+    with flask_app.app_context():
+        db_url = db.engine.url.render_as_string(hide_password=False)
+
+    return AsyncReadApp(
+        flask_app,
+        db_url,
+        redis_url=os.getenv("REDIS_URL"),
+        cache_ttl=int(os.getenv("ASGI_CACHE_TTL", "0")),
+        max_rss=int(os.getenv("WORKER_MAX_RSS_MB", "0")) * 1024 * 1024,
+    )
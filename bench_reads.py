@@ -0,0 +1,128 @@
+"""
+bench_reads.py
+
+Compares the list endpoints' read path in reads.py with the ORM path they used before, on a generated
+catalog in a temporary sqlite database.
+
+    python bench_reads.py [--items 5000] [--stores 50] [--tags 200] [--repeat 3]
+
+For each endpoint both paths run the queries and dump the result with the endpoint's response
+schema, like the view does. Reported per path:
+- cpu: best process CPU time of --repeat runs, and per row returned
+- peak: largest amount of Python memory allocated at once during one run (tracemalloc)
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import insert
+
+# The app connects to redis lazily, nothing is sent to it here
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+
+from app import create_app
+from db import db
+from models import StoreModel, ItemModel, TagModel, ItemsTags
+from schemas import ItemSchema, StoreSchema, TagSchema
+import reads
+
+
+def seed(stores, items, tags, links_per_item):
+    random.seed(0)
+    db.session.execute(insert(StoreModel), [{"id": n, "name": f"store-{n}"} for n in range(1, stores + 1)])
+    tag_rows = [{"id": n, "name": f"tag-{n}", "store_id": n % stores + 1} for n in range(1, tags + 1)]
+    db.session.execute(insert(TagModel), tag_rows)
+    db.session.execute(insert(ItemModel), [
+        {"id": n, "name": f"item-{n}", "price": round(random.uniform(1, 100), 2), "store_id": n % stores + 1}
+        for n in range(1, items + 1)
+    ])
+    tags_by_store = {}
+    for row in tag_rows:
+        tags_by_store.setdefault(row["store_id"], []).append(row["id"])
+    links = []
+    for n in range(1, items + 1):
+        store_tags = tags_by_store.get(n % stores + 1, [])
+        links += [{"item_id": n, "tag_id": tag_id} for tag_id in random.sample(store_tags, min(links_per_item, len(store_tags)))]
+    db.session.execute(insert(ItemsTags), links)
+    db.session.commit()
+
+
+# endpoint -> (ORM path as the view had it, path through reads.py)
+def cases(store_id):
+    return {
+        "GET /item": (
+            lambda: ItemSchema(many=True).dump(ItemModel.query.all()),
+            lambda: ItemSchema(many=True).dump(reads.items()),
+        ),
+        "GET /store": (
+            lambda: StoreSchema(many=True).dump(StoreModel.query.all()),
+            lambda: StoreSchema(many=True).dump(reads.stores()),
+        ),
+        f"GET /store/{store_id}/tag": (
+            lambda: TagSchema(many=True).dump(db.session.get(StoreModel, store_id).tags.all()),
+            lambda: TagSchema(many=True).dump(reads.store_tags(store_id)),
+        ),
+    }
+
+
+# Rows in a dumped response, counting the nested ones
+def count_rows(data):
+    if isinstance(data, list):
+        return sum(count_rows(entry) for entry in data)
+    if isinstance(data, dict):
+        return 1 + sum(count_rows(value) for value in data.values() if isinstance(value, (list, dict)))
+    return 0
+
+
+def measure(run, repeat):
+    best = None
+    for _ in range(repeat):
+        # A fresh session each time, like a new request
+        db.session.remove()
+        started = time.process_time()
+        result = run()
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    db.session.remove()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the list endpoints: ORM path vs reads.py")
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--stores", type=int, default=50)
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--links-per-item", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        with app.app_context():
+            db.create_all()
+            seed(args.stores, args.items, args.tags, args.links_per_item)
+            print(f"{args.items} items, {args.stores} stores, {args.tags} tags, best of {args.repeat} runs\n")
+            print(f"{'endpoint':<20} {'path':<6} {'rows':>8} {'cpu ms':>9} {'us/row':>8} {'peak MB':>9}")
+
+            for endpoint, (orm_run, core_run) in cases(store_id=1).items():
+                orm_cpu, orm_peak, orm_result = measure(orm_run, args.repeat)
+                core_cpu, core_peak, core_result = measure(core_run, args.repeat)
+                rows = count_rows(orm_result)
+                if rows != count_rows(core_result):
+                    print(f"{endpoint}: the two paths returned different data")
+                for path, cpu, peak in (("orm", orm_cpu, orm_peak), ("core", core_cpu, core_peak)):
+                    print(f"{endpoint:<20} {path:<6} {rows:>8} {cpu * 1000:>9.1f} {cpu * 1e6 / max(rows, 1):>8.2f} {peak / 2**20:>9.1f}")
+                print(f"{'':<20} {'':<6} {'':>8} {orm_cpu / core_cpu:>8.1f}x {'':>8} {orm_peak / core_peak:>8.1f}x\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+boot.py
+
+Helpers for starting a container quickly, used by docker-entrypoint.sh.
+
+    python boot.py migrate   Run "flask db upgrade" only when the database is not at the latest revision
+    python boot.py report    Print how long the imports and each phase of create_app() take
+
+The revision check only reads the migration files and the alembic_version table, so it avoids
+importing the whole app and walking the Alembic history on every start.
+"""
+
+import ast
+import os
+import re
+import subprocess
+import sys
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+VERSIONS_DIR = os.path.join(ROOT, "migrations", "versions")
+
+REVISION = re.compile(r"^revision\s*=\s*(.+)$", re.MULTILINE)
+DOWN_REVISION = re.compile(r"^down_revision\s*=\s*(.+)$", re.MULTILINE)
+
+
+# Latest revision(s) in migrations/versions: the ones no other revision builds on
+def head_revisions(versions_dir=VERSIONS_DIR):
+    revisions = set()
+    parents = set()
+    for filename in os.listdir(versions_dir):
+        if not filename.endswith(".py"):
+            continue
+        with open(os.path.join(versions_dir, filename)) as f:
+            source = f.read()
+        revision = REVISION.search(source)
+        if revision is None:
+            continue
+        revisions.add(ast.literal_eval(revision.group(1)))
+        down_revision = ast.literal_eval(DOWN_REVISION.search(source).group(1))
+        if isinstance(down_revision, str):
+            parents.add(down_revision)
+        elif down_revision:
+            # Merge revisions have a tuple of parents
+            parents.update(down_revision)
+    return revisions - parents
+
+
+# Same database url create_app uses, with relative sqlite paths resolved against the instance folder like flask-sqlalchemy does
+def database_url():
+    load_dotenv()
+    url = make_url(os.getenv("DATABASE_URL", "sqlite:///data.db"))
+    if url.drivername.startswith("sqlite") and url.database and url.database != ":memory:" and not os.path.isabs(url.database):
+        url = url.set(database=os.path.join(ROOT, "instance", url.database))
+    return url
+
+
+def current_revisions(url):
+    engine = create_engine(url)
+    try:
+        with engine.connect() as connection:
+            return {row[0] for row in connection.execute(text("SELECT version_num FROM alembic_version"))}
+    except SQLAlchemyError:
+        # No alembic_version table yet (new database)
+        return set()
+    finally:
+        engine.dispose()
+
+
+def migrate():
+    heads = head_revisions()
+    current = current_revisions(database_url())
+    if current == heads:
+        print(f"Database is at the latest revision ({', '.join(sorted(heads))}), skipping migrations.")
+        return 0
+    print(f"Database is at {', '.join(sorted(current)) or 'no revision'}, running flask db upgrade.")
+    return subprocess.call(["flask", "db", "upgrade"], cwd=ROOT)
+
+
+def report():
+    from startup import time_imports, format_report
+
+    import_timings = time_imports()
+    from app import create_app
+
+    app = create_app()
+    print(format_report(import_timings, app.startup_timer))
+    return 0
+
+
+if __name__ == "__main__":
+    commands = {"migrate": migrate, "report": report}
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        print(f"Usage: python boot.py [{'|'.join(commands)}]")
+        sys.exit(2)
+    sys.exit(commands[sys.argv[1]]())
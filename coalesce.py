@@ -0,0 +1,258 @@
+"""
+coalesce.py
+
+Single-flight request coalescing for hot read endpoints. When many requests ask for the
+same key at the same time (a popular store page right after a deploy, for example), only
+one of them (the leader) runs the queries and serialization. Everyone else waits for the
+leader and is handed the same result.
+
+- Within a worker: followers wait on a threading.Event (gunicorn.conf.py runs GUNICORN_THREADS
+  threads per worker for this; with GUNICORN_THREADS=1 a worker handles one request at a time and
+  only the redis layer below can coalesce)
+- Across workers (optional): the leader takes a Redis lock, writes the result to Redis and
+  the other workers poll for it instead of running the query themselves
+- Stampede protection: when a ttl is set, results are kept and refreshed early with
+  probability growing as expiry approaches (XFetch), so a hot key never expires for
+  everyone at once
+- Invalidation: every key has a generation, bumped by invalidate() (in redis when it is configured,
+  so a write in one worker reaches the others). Cached results remember the generation they were
+  computed under and are dropped on a hit once it moved on, and a leader that was computing while
+  a write happened does not cache what it got
+
+Results must be plain data (the dumped schema output) since they are shared between threads
+and workers, ORM objects would still be tied to the leader's session.
+"""
+
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from redis.exceptions import RedisError
+
+# Lua script so a leader only deletes the lock if it still owns it
+RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class _Entry:
+    def __init__(self, value, delta, expiry, generation):
+        self.value = value
+        # How long the value took to compute, used to scale the early refresh window
+        self.delta = delta
+        self.expiry = expiry
+        self.generation = generation
+
+
+class SingleFlight:
+    def __init__(self, redis_connection=None, ttl=0, beta=1.0, lock_timeout=10, poll_interval=0.01, namespace="coalesce"):
+        self.redis = redis_connection
+        # Seconds to keep a result after computing it, 0 only coalesces requests that are in flight together
+        self.ttl = ttl
+        # Higher beta means refreshing earlier before expiry
+        self.beta = beta
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.namespace = namespace
+
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._cache = {}
+        # Generations of invalidated keys when there is no redis
+        self._generations = Counter()
+        self._last_eviction = time.time()
+        self._stats = Counter()
+
+    # Returns fn() for the key, sharing a single computation between concurrent callers
+    def do(self, key, fn):
+        self._count("requests")
+        now = time.time()
+        entry = self._cache.get(key)
+        if entry is not None and now >= entry.expiry:
+            entry = None
+        if entry is not None:
+            # Written to since it was cached, maybe by another worker
+            # If redis can't tell, keep serving it until it expires
+            generation = self._generation(key)
+            if generation is not None and generation != entry.generation:
+                self._count("invalidated_hits")
+                entry = None
+
+        with self._lock:
+            call = self._calls.get(key)
+            if entry is not None:
+                # Serve the cached value unless this request wins the early refresh draw
+                # If someone is already refreshing, keep serving the current value meanwhile
+                if call is not None or not self._refresh_early(entry, now):
+                    self._stats["cache_hits"] += 1
+                    return entry.value
+                self._stats["early_refreshes"] += 1
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            self._count("coalesced")
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        start = time.time()
+        try:
+            generation = self._generation(key)
+            call.value = self._compute(key, fn, generation)
+            # Only keep the result if nothing invalidated the key while it was computed
+            if self.ttl and generation is not None and self._generation(key) == generation:
+                delta = time.time() - start
+                self._cache[key] = _Entry(call.value, delta, time.time() + self.ttl, generation)
+                self._evict_expired()
+            self._count("leaders")
+            return call.value
+        except Exception as e:
+            # Followers get the same exception (e.g. the 404 from get_or_404)
+            call.error = e
+            self._count("errors")
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    # Drop cached results for the keys, called after writes that change them
+    # Bumping the generations in redis makes the other workers drop theirs on the next hit
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._cache.pop(key, None)
+                self._generations[key] += 1
+        if self.redis is not None:
+            try:
+                pipeline = self.redis.pipeline()
+                for key in keys:
+                    pipeline.incr(self._generation_key(key))
+                pipeline.execute()
+            except RedisError:
+                self._count("redis_errors")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._calls)
+            stats["cached_keys"] = len(self._cache)
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    # XFetch: recompute when now - delta * beta * log(rand) passes the expiry
+    def _refresh_early(self, entry, now):
+        return now - entry.delta * self.beta * math.log(random.random() or 1e-12) >= entry.expiry
+
+    # Drop expired entries, at most once per ttl so a write does not scan the cache every time
+    def _evict_expired(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_eviction < self.ttl:
+                return
+            self._last_eviction = now
+            for key, entry in list(self._cache.items()):
+                if entry.expiry <= now:
+                    del self._cache[key]
+
+    # Current generation of the key, None when redis is configured but could not be reached
+    def _generation(self, key):
+        if self.redis is None:
+            return self._generations[key]
+        try:
+            return int(self.redis.get(self._generation_key(key)) or 0)
+        except RedisError:
+            self._count("redis_errors")
+            return None
+
+    def _generation_key(self, key):
+        return f"{self.namespace}:generation:{key}"
+
+    # Results and locks are per generation, so requests arriving after a write never pick up
+    # (or wait for) a computation that started before it
+    def _result_key(self, key, generation):
+        return f"{self.namespace}:result:{key}:{generation}"
+
+    def _lock_key(self, key, generation):
+        return f"{self.namespace}:lock:{key}:{generation}"
+
+    # Run fn, coordinating with the other workers through redis when a connection is configured
+    def _compute(self, key, fn, generation):
+        if self.redis is None or generation is None:
+            return fn()
+
+        result_key = self._result_key(key, generation)
+        lock_key = self._lock_key(key, generation)
+        try:
+            cached = self.redis.get(result_key)
+            if cached is not None:
+                self._count("remote_coalesced")
+                return json.loads(cached)
+
+            token = uuid.uuid4().hex
+            if self.redis.set(lock_key, token, nx=True, px=int(self.lock_timeout * 1000)):
+                try:
+                    value = fn()
+                    self._publish(result_key, value)
+                    return value
+                finally:
+                    self._release(lock_key, token)
+
+            # Another worker is computing the value, wait for it to show up
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                time.sleep(self.poll_interval)
+                cached = self.redis.get(result_key)
+                if cached is not None:
+                    self._count("remote_coalesced")
+                    return json.loads(cached)
+                if not self.redis.exists(lock_key):
+                    # The other leader failed, compute it here
+                    break
+        except RedisError:
+            self._count("redis_errors")
+
+        return fn()
+
+    # Redis failures after the leader computed the value should not make it compute again
+    def _publish(self, result_key, value):
+        # Without a ttl, keep the result just long enough for the workers polling for it to pick it up
+        linger = self.ttl or 1
+        try:
+            self.redis.set(result_key, json.dumps(value), px=int(linger * 1000))
+        except RedisError:
+            self._count("redis_errors")
+
+    def _release(self, lock_key, token):
+        try:
+            self.redis.eval(RELEASE_LOCK, 1, lock_key, token)
+        except RedisError:
+            self._count("redis_errors")
+
+
+# Coalescing keys for the store read endpoints, shared by the resources that read and write them
+def store_keys(store_id):
+    return (f"store:{store_id}", f"store:{store_id}:tags")
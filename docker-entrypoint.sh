@@ -1,5 +1,31 @@
 #!/bin/sh
 
-flask db upgrade
+# One-shot migration step, e.g. a release job run before new containers start:
+#   docker run <image> /bin/bash docker-entrypoint.sh migrate
+if [ "$1" = "migrate" ]; then
+    exec flask db upgrade
+fi
 
-exec gunicorn --bind 0.0.0.0:80 "app:create_app()"
\ No newline at end of file
+# Background job workers, run as a separate container from the same image:
+#   docker run <image> /bin/bash docker-entrypoint.sh worker
+# Queues and processes per queue are set in settings.py (WORKER_CONCURRENCY overrides them)
+if [ "$1" = "worker" ]; then
+    exec flask jobs worker
+fi
+
+# MIGRATIONS controls what happens to the database schema when the container starts
+#   auto (default): only run flask db upgrade if the database is behind (see boot.py)
+#   always: run flask db upgrade every time
+#   skip: never, migrations run in the one-shot step above
+case "${MIGRATIONS:-auto}" in
+    always) flask db upgrade ;;
+    auto) python boot.py migrate ;;
+esac
+
+# Settings such as the bind address and app preloading are in gunicorn.conf.py
+# SERVER_MODE=asgi serves the item/store/tag reads on asyncio (see asgi.py), writes still go to the flask app
+if [ "$SERVER_MODE" = "asgi" ]; then
+    exec gunicorn -k uvicorn_worker.UvicornWorker "asgi:create_asgi_app()"
+fi
+
+exec gunicorn "app:create_app()"
@@ -0,0 +1,72 @@
+# Gunicorn settings, picked up automatically when gunicorn starts in this directory
+
+import os
+
+from startup import time_imports, format_report
+
+bind = "0.0.0.0:80"
+
+# Import and build the app once in the master process, workers are forked from it with the app
+# already loaded instead of each importing the app, blueprints and models again
+# GUNICORN_PRELOAD=0 goes back to loading the app in every worker
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# Threads per worker (gunicorn uses its gthread worker when this is above 1), so a worker serves
+# several requests at once and identical concurrent reads can share one computation (see coalesce.py)
+# GUNICORN_THREADS=1 is the plain sync worker, one request at a time. The uvicorn worker used with
+# SERVER_MODE=asgi ignores it, the flask app runs in asgiref's thread pool there
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+
+# STARTUP_REPORT=1 logs how long imports and create_app() took (see startup.py)
+# Imports are timed here since gunicorn reads this file before loading the app
+startup_report = os.getenv("STARTUP_REPORT") == "1"
+import_timings = time_imports() if startup_report and preload_app else []
+
+# Recycle workers before slow leaks add up: a worker exits after finishing its current request once it
+# has served MAX_REQUESTS requests (plus up to MAX_REQUESTS_JITTER so they do not all restart together)
+# or once its RSS is above WORKER_MAX_RSS_MB, and the master starts a fresh one. 0 turns a limit off
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", str(max_requests // 10)))
+max_worker_rss = int(os.getenv("WORKER_MAX_RSS_MB", "0")) * 1024 * 1024
+
+
+def when_ready(server):
+    if startup_report and preload_app:
+        app = server.app.wsgi()
+        flask_app = getattr(app, "flask_app", app)
+        server.log.info(format_report(import_timings, flask_app.startup_timer))
+
+
+# Connections opened in the master must not be shared with the workers after the fork
+def post_fork(server, worker):
+    if not preload_app:
+        return
+
+    from db import db
+
+    app = server.app.wsgi()
+    # In SERVER_MODE=asgi the app is the AsyncReadApp from asgi.py wrapping the flask app
+    flask_app = getattr(app, "flask_app", app)
+
+    # close=False leaves the master's connections alone and gives this worker a fresh pool
+    with flask_app.app_context():
+        db.engine.dispose(close=False)
+    if hasattr(app, "engine"):
+        app.engine.sync_engine.dispose(close=False)
+
+    flask_app.redis.connection_pool.reset()
+
+
+# Memory threshold for recycling, checked after every request (sync and threaded workers)
+# The uvicorn worker used with SERVER_MODE=asgi does not call this hook, asgi.py checks it there
+def post_request(worker, req, environ, resp):
+    if not max_worker_rss:
+        return
+
+    from memory import current_rss
+
+    rss = current_rss()
+    if rss > max_worker_rss:
+        worker.log.info(f"Worker {worker.pid} RSS is {rss // (1024 * 1024)}MB, above WORKER_MAX_RSS_MB, recycling it.")
+        # Same graceful exit gunicorn uses for max_requests
+        worker.alive = False
@@ -0,0 +1,302 @@
+"""
+jobs.py
+
+Background jobs on top of RQ: priority queues, a multi-process worker pool, deduplicated and
+delayed enqueues, and job metrics.
+
+Enqueue through app.jobs (set up in create_app):
+
+    current_app.jobs.enqueue(send_user_registration_email, email, username, queue="emails")
+    current_app.jobs.enqueue(rebuild_report, store_id, dedup_key=f"report:{store_id}")
+    current_app.jobs.enqueue(send_reminder, user_id, delay=3600)
+
+- queue: one of settings.QUEUES, "default" if not given
+- dedup_key: while a job with the same key is queued, scheduled or running, enqueueing again returns
+  that job instead of adding a new one. The key is released when the job finishes or fails, or
+  dedup_ttl seconds after the job was due if the worker died without finishing it
+- delay (seconds) or at (datetime): run the job later, through the RQ scheduler the workers run
+
+Workers:
+
+    flask jobs worker       start the pool configured in settings.py (QUEUES, QUEUE_CONCURRENCY)
+    flask jobs stats        print queue depth, wait time, run time and failure rate per queue
+
+The pool starts QUEUE_CONCURRENCY[queue] processes for each queue. Each process listens on its queue
+first and on the lower priority queues after it, so high priority jobs get dedicated workers and
+idle workers help with the rest. Dead processes are restarted, SIGTERM stops them all after their
+current job.
+
+Metrics are recorded by the workers in redis (success/failure callbacks on every job enqueued here),
+and served at GET /metrics/jobs.
+"""
+
+import math
+import multiprocessing
+import signal
+import time
+from datetime import timedelta, timezone
+from uuid import uuid4
+
+import click
+import redis
+from flask import current_app
+from flask.cli import AppGroup
+from redis.exceptions import RedisError
+from rq import Queue, Worker
+from rq.job import Callback, Job, JobStatus
+
+import settings
+
+# Deletes the dedup key only if it still points at the job that finished
+RELEASE_DEDUP_KEY = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# Recent wait and run times kept per queue for the percentiles
+SAMPLES_KEPT = 1000
+
+# Statuses in which a job still holds its dedup key
+PENDING_STATUSES = {JobStatus.QUEUED, JobStatus.SCHEDULED, JobStatus.DEFERRED, JobStatus.STARTED}
+
+
+def _metrics_key(queue_name):
+    return f"jobs:metrics:{queue_name}"
+
+
+def _dedup_key(key):
+    return f"jobs:dedup:{key}"
+
+
+class JobQueues:
+    def __init__(self, redis_connection, queue_names=None, default_queue="default", dedup_ttl=3600):
+        self.redis = redis_connection
+        self.queue_names = list(queue_names or settings.QUEUES)
+        self.queues = {name: Queue(name, connection=redis_connection) for name in self.queue_names}
+        self.default_queue = default_queue
+        self.dedup_ttl = dedup_ttl
+
+    def queue(self, name=None):
+        return self.queues[name or self.default_queue]
+
+    def enqueue(self, func, *args, queue=None, dedup_key=None, delay=None, at=None, **kwargs):
+        rq_queue = self.queue(queue)
+        job_id = str(uuid4())
+        if dedup_key is not None:
+            existing = self._claim(dedup_key, job_id, self._dedup_seconds(delay, at))
+            if existing is not None:
+                self._count(rq_queue.name, "deduplicated")
+                return existing
+
+        options = {
+            "job_id": job_id,
+            "meta": {"dedup_key": dedup_key},
+            "on_success": Callback(record_success),
+            "on_failure": Callback(record_failure),
+            **kwargs,
+        }
+        try:
+            if at is not None:
+                job = rq_queue.enqueue_at(at, func, *args, **options)
+            elif delay:
+                job = rq_queue.enqueue_in(timedelta(seconds=delay), func, *args, **options)
+            else:
+                job = rq_queue.enqueue(func, *args, **options)
+        except Exception:
+            # Nothing was queued, let the next enqueue with this key through
+            if dedup_key is not None:
+                release_dedup_key(self.redis, dedup_key, job_id)
+            raise
+        self._count(rq_queue.name, "enqueued")
+        return job
+
+    # A delayed job holds its key while it waits for its turn, plus dedup_ttl once it is due
+    def _dedup_seconds(self, delay=None, at=None):
+        if at is not None:
+            # RQ reads naive datetimes as UTC
+            if at.tzinfo is None:
+                at = at.replace(tzinfo=timezone.utc)
+            wait = at.timestamp() - time.time()
+        else:
+            wait = delay or 0
+        return math.ceil(max(0, wait)) + self.dedup_ttl
+
+    # Takes the dedup key for job_id, or returns the job already holding it
+    def _claim(self, dedup_key, job_id, ttl):
+        key = _dedup_key(dedup_key)
+        for _attempt in range(3):
+            if self.redis.set(key, job_id, nx=True, ex=ttl):
+                return None
+            holder = self.redis.get(key)
+            if holder is None:
+                # Released in between, try to take it again
+                continue
+            try:
+                job = Job.fetch(holder.decode(), connection=self.redis)
+                if job.get_status() in PENDING_STATUSES:
+                    return job
+            except Exception:
+                # The job expired or was deleted without releasing its key
+                pass
+            release_dedup_key(self.redis, dedup_key, holder.decode())
+        raise RuntimeError(f"Could not claim dedup key {dedup_key!r}.")
+
+    def _count(self, queue_name, field):
+        try:
+            self.redis.hincrby(_metrics_key(queue_name), field, 1)
+        except RedisError:
+            pass
+
+    def stats(self):
+        return {name: queue_stats(self.redis, queue) for name, queue in self.queues.items()}
+
+
+def release_dedup_key(connection, dedup_key, job_id):
+    connection.eval(RELEASE_DEDUP_KEY, 1, _dedup_key(dedup_key), job_id)
+
+
+# RQ callbacks, run by the worker after each job enqueued through JobQueues
+
+def record_success(job, connection, result, *args, **kwargs):
+    _record(job, connection, "succeeded")
+
+
+def record_failure(job, connection, exc_type, exc_value, traceback):
+    _record(job, connection, "failed")
+
+
+def _record(job, connection, outcome):
+    key = _metrics_key(job.origin)
+    pipeline = connection.pipeline()
+    pipeline.hincrby(key, outcome, 1)
+    # Wait: enqueued (or moved from the schedule to the queue) until a worker started it
+    if job.enqueued_at and job.started_at:
+        wait = (job.started_at - job.enqueued_at).total_seconds()
+        pipeline.hincrbyfloat(key, "wait_seconds_total", wait)
+        pipeline.lpush(f"{key}:wait", wait)
+        pipeline.ltrim(f"{key}:wait", 0, SAMPLES_KEPT - 1)
+    if job.started_at and job.ended_at:
+        run = (job.ended_at - job.started_at).total_seconds()
+        pipeline.hincrbyfloat(key, "run_seconds_total", run)
+        pipeline.lpush(f"{key}:run", run)
+        pipeline.ltrim(f"{key}:run", 0, SAMPLES_KEPT - 1)
+    pipeline.execute()
+
+    dedup_key = job.meta.get("dedup_key")
+    if dedup_key is not None:
+        release_dedup_key(connection, dedup_key, job.id)
+
+
+def _percentile(samples, percent):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return round(samples[min(len(samples) - 1, int(len(samples) * percent / 100))], 4)
+
+
+def queue_stats(connection, queue):
+    key = _metrics_key(queue.name)
+    counters = {field.decode(): float(value) for field, value in connection.hgetall(key).items()}
+    waits = [float(value) for value in connection.lrange(f"{key}:wait", 0, -1)]
+    runs = [float(value) for value in connection.lrange(f"{key}:run", 0, -1)]
+    succeeded = int(counters.get("succeeded", 0))
+    failed = int(counters.get("failed", 0))
+    finished = succeeded + failed
+    return {
+        # Depth: jobs waiting in the queue, plus the ones scheduled for later and running now
+        "queued": queue.count,
+        "scheduled": queue.scheduled_job_registry.count,
+        "started": queue.started_job_registry.count,
+        "failed_registry": queue.failed_job_registry.count,
+        "enqueued": int(counters.get("enqueued", 0)),
+        "deduplicated": int(counters.get("deduplicated", 0)),
+        "succeeded": succeeded,
+        "failed": failed,
+        "failure_rate": round(failed / finished, 4) if finished else 0,
+        "wait_seconds": {
+            "avg": round(counters.get("wait_seconds_total", 0) / finished, 4) if finished else None,
+            "p50": _percentile(waits, 50),
+            "p95": _percentile(waits, 95),
+        },
+        "run_seconds": {
+            "avg": round(counters.get("run_seconds_total", 0) / finished, 4) if finished else None,
+            "p50": _percentile(runs, 50),
+            "p95": _percentile(runs, 95),
+        },
+    }
+
+
+# Worker pool
+
+# Queues each worker process listens on, highest priority first
+def worker_plan(queue_names, concurrency):
+    plan = []
+    for index, name in enumerate(queue_names):
+        plan += [queue_names[index:]] * concurrency.get(name, 0)
+    return plan
+
+
+def _work(redis_url, queue_names):
+    connection = redis.from_url(redis_url)
+    queues = [Queue(name, connection=connection) for name in queue_names]
+    # Every worker runs the scheduler loop, RQ lets only one of them move due jobs at a time
+    Worker(queues, connection=connection).work(with_scheduler=True)
+
+
+class WorkerPool:
+    def __init__(self, redis_url, queue_names, concurrency, restart_delay=1):
+        self.redis_url = redis_url
+        self.plan = worker_plan(queue_names, concurrency)
+        self.restart_delay = restart_delay
+        self.processes = [None] * len(self.plan)
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        # Ctrl-C reaches the workers directly (same process group), they stop after their current job
+        signal.signal(signal.SIGINT, self._stop_quietly)
+        while not self.stopping:
+            for slot, queue_names in enumerate(self.plan):
+                process = self.processes[slot]
+                if process is None or not process.is_alive():
+                    if process is not None:
+                        click.echo(f"Worker for {','.join(queue_names)} exited with {process.exitcode}, restarting.")
+                    self.processes[slot] = self._start(queue_names)
+            time.sleep(self.restart_delay)
+        for process in self.processes:
+            if process is not None:
+                process.join()
+
+    def _start(self, queue_names):
+        process = multiprocessing.Process(target=_work, args=(self.redis_url, queue_names))
+        process.start()
+        return process
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+
+    def _stop_quietly(self, signum, frame):
+        self.stopping = True
+
+
+jobs_cli = AppGroup("jobs", help="Background job workers and metrics.")
+
+
+@jobs_cli.command("worker")
+def worker_command():
+    """Start the worker pool configured in settings.py."""
+    pool = WorkerPool(settings.REDIS_URL, settings.QUEUES, settings.QUEUE_CONCURRENCY)
+    click.echo(f"Starting {len(pool.plan)} workers: " + ", ".join(",".join(names) for names in pool.plan))
+    pool.run()
+
+
+@jobs_cli.command("stats")
+def stats_command():
+    """Print queue depth, wait time, run time and failure rate per queue."""
+    for name, stats in current_app.jobs.stats().items():
+        click.echo(f"{name}: {stats}")
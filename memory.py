@@ -0,0 +1,216 @@
+"""
+memory.py
+
+Memory accounting for the app workers, to find out why their RSS grows over time.
+
+Always on (cheap, registered in create_app):
+- gauges for this worker: RSS, Python heap blocks, gc counts, and the size of the usual suspects
+  (the in-memory BLOCKLIST, the Jinja template cache in tasks.py)
+- per route: requests, RSS growth while serving them, and the most ORM objects loaded by one request
+  (list endpoints loading every row with query.all() show up here)
+- every publish_interval seconds the gauges are written to redis, so GET /memory/workers shows every
+  worker, not just the one that answered
+
+With tracemalloc on (MEMORY_TRACE=1 at start, or POST /memory/tracemalloc):
+- per route allocation peak: the most memory allocated at once during a request, above what was
+  allocated when it started (peaks are process wide, so they are exact with one request at a time)
+- snapshot diffs: POST /memory/tracemalloc takes a baseline, GET /memory/tracemalloc lists the
+  lines that allocated most since then. Take the baseline, let traffic run, then look at the diff
+
+Recycling workers that grew too large is configured in gunicorn.conf.py (WORKER_MAX_RSS_MB, MAX_REQUESTS).
+Its post_request hook only runs for the sync and threaded workers; with SERVER_MODE=asgi the uvicorn
+worker skips it and AsyncReadApp.check_rss in asgi.py applies WORKER_MAX_RSS_MB instead.
+"""
+
+import gc
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+from flask import has_request_context, request
+from redis.exceptions import RedisError
+from sqlalchemy import event
+
+import tasks
+from blocklist import BLOCKLIST
+from db import db
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+WORKERS_KEY = "memory:workers"
+
+# Allocations made by tracemalloc itself and by imports are noise in the diffs
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+# Resident set size of this process in bytes
+def current_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # No /proc (e.g. macOS): fall back to the peak RSS, reported in KB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryMonitor:
+    def __init__(self, app, redis_connection=None, publish_interval=10):
+        self.redis = redis_connection
+        self.publish_interval = publish_interval
+        self.started_at = time.time()
+        self.baseline = None
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._last_publish = 0
+
+        if os.getenv("MEMORY_TRACE") == "1":
+            self.start_tracing(int(os.getenv("MEMORY_TRACE_FRAMES", "1")))
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        # Count the model instances each request loads from the database
+        event.listen(db.Model, "load", self._count_load, propagate=True)
+
+    # Worked out per call, with preload_app the monitor is created in the gunicorn master before the fork
+    @property
+    def worker(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def before_request(self):
+        traced = 0
+        if tracemalloc.is_tracing():
+            # Peak from here on belongs to this request
+            tracemalloc.reset_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+        request.environ["memory.start"] = (current_rss(), traced)
+        request.environ["memory.loaded"] = 0
+
+    def _count_load(self, target, context):
+        if has_request_context() and "memory.loaded" in request.environ:
+            request.environ["memory.loaded"] += 1
+
+    def after_request(self, response):
+        start = request.environ.pop("memory.start", None)
+        if start is None or request.url_rule is None:
+            return response
+        rss = current_rss()
+        alloc_peak = tracemalloc.get_traced_memory()[1] - start[1] if tracemalloc.is_tracing() else None
+        loaded = request.environ.pop("memory.loaded", 0)
+
+        route = f"{request.method} {request.url_rule.rule}"
+        with self._lock:
+            stats = self._routes.setdefault(route, {
+                "requests": 0, "rss_growth_bytes": 0, "max_orm_objects_loaded": 0,
+                "traced_requests": 0, "alloc_peak_total_bytes": 0, "alloc_peak_max_bytes": 0,
+            })
+            stats["requests"] += 1
+            stats["rss_growth_bytes"] += rss - start[0]
+            stats["max_orm_objects_loaded"] = max(stats["max_orm_objects_loaded"], loaded)
+            if alloc_peak is not None:
+                stats["traced_requests"] += 1
+                stats["alloc_peak_total_bytes"] += alloc_peak
+                stats["alloc_peak_max_bytes"] = max(stats["alloc_peak_max_bytes"], alloc_peak)
+
+        if self.redis is not None and time.time() - self._last_publish >= self.publish_interval:
+            self.publish()
+        return response
+
+    def gauges(self):
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        jinja_cache = tasks.template_env.cache
+        return {
+            "worker": self.worker,
+            "uptime_seconds": round(time.time() - self.started_at),
+            "rss_bytes": current_rss(),
+            "heap_blocks": sys.getallocatedblocks(),
+            "gc_counts": gc.get_count(),
+            "tracing": tracemalloc.is_tracing(),
+            "traced_bytes": traced,
+            "traced_peak_bytes": traced_peak,
+            "blocklist_size": len(BLOCKLIST),
+            "jinja_cache_size": len(jinja_cache) if jinja_cache is not None else 0,
+        }
+
+    def routes(self):
+        with self._lock:
+            routes = {route: dict(stats) for route, stats in self._routes.items()}
+        for stats in routes.values():
+            stats["alloc_peak_avg_bytes"] = (
+                stats["alloc_peak_total_bytes"] // stats["traced_requests"] if stats["traced_requests"] else None
+            )
+        return routes
+
+    def summary(self):
+        return {**self.gauges(), "objects": len(gc.get_objects()), "routes": self.routes()}
+
+    # Write this worker's gauges to redis for GET /memory/workers
+    def publish(self):
+        self._last_publish = time.time()
+        try:
+            self.redis.hset(WORKERS_KEY, self.worker, json.dumps({**self.gauges(), "published_at": self._last_publish}))
+        except RedisError:
+            pass
+
+    # Latest gauges of every worker that published recently, entries of workers gone quiet are dropped
+    def workers(self):
+        if self.redis is None:
+            return [self.gauges()]
+        self.publish()
+        try:
+            published = self.redis.hgetall(WORKERS_KEY)
+        except RedisError:
+            return [self.gauges()]
+        workers = []
+        stale = []
+        for worker, value in published.items():
+            gauges = json.loads(value)
+            if time.time() - gauges["published_at"] > 3 * self.publish_interval:
+                stale.append(worker)
+            else:
+                workers.append(gauges)
+        if stale:
+            try:
+                self.redis.hdel(WORKERS_KEY, *stale)
+            except RedisError:
+                pass
+        return sorted(workers, key=lambda gauges: gauges["worker"])
+
+    # Start tracemalloc (if needed) and take the baseline snapshot for diffs
+    def start_tracing(self, frames=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.baseline = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+    def stop_tracing(self):
+        tracemalloc.stop()
+        self.baseline = None
+
+    # Biggest allocation changes since the baseline, group_by is "lineno", "filename" or "traceback"
+    def diff(self, limit=20, group_by="lineno", rebase=False):
+        snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        stats = snapshot.compare_to(self.baseline, group_by)
+        if rebase:
+            self.baseline = snapshot
+        return {
+            "size_diff_total_bytes": sum(stat.size_diff for stat in stats),
+            "top": [
+                {
+                    "where": stat.traceback.format() if group_by == "traceback" else str(stat.traceback[0]),
+                    "size_bytes": stat.size,
+                    "size_diff_bytes": stat.size_diff,
+                    "count": stat.count,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in stats[:limit]
+            ],
+        }
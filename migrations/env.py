@@ -2,6 +2,7 @@ import logging
 from logging.config import fileConfig
 
 from flask import current_app
+from sqlalchemy import text
 
 from alembic import context
 
@@ -93,6 +94,13 @@ def run_migrations_online():
     connectable = get_engine()
 
     with connectable.connect() as connection:
+        # Set by "flask online upgrade" (see online_migrations.py): DDL that cannot get its lock
+        # in time fails instead of queueing every other query on the table behind it
+        lock_timeout = current_app.config.get('MIGRATION_LOCK_TIMEOUT')
+        if lock_timeout and connection.dialect.name == 'postgresql':
+            connection.execute(text("SELECT set_config('lock_timeout', :timeout, false)"), {"timeout": lock_timeout})
+            connection.commit()
+
         context.configure(
             connection=connection,
             target_metadata=get_metadata(),
@@ -0,0 +1,317 @@
+"""
+online_migrations.py
+
+Helpers for changing large tables (items, items_tags) without locking them for the whole
+migration, plus a "flask online" command group to run them.
+
+In a revision file:
+
+    from online_migrations import create_index_concurrently, backfill
+
+    def upgrade():
+        op.add_column("items", sa.Column("price_cents", sa.Integer(), nullable=True))
+        create_index_concurrently("ix_items_store_id", "items", ["store_id"])
+        backfill("items_price_cents", "items", {"price_cents": sa.text("CAST(price * 100 AS INTEGER)")})
+
+- create_index_concurrently: CREATE INDEX CONCURRENTLY on Postgres (run outside the migration
+  transaction, as Postgres requires), a normal CREATE INDEX elsewhere. When a concurrent build
+  fails part way (cancelled, deadlock, duplicate key for a unique index), Postgres keeps the
+  half-built index marked INVALID under that name. Fix the cause and run the upgrade again: the
+  invalid index is dropped and built anew, a valid one with the same name is kept
+- backfill: UPDATE in primary key batches, one short transaction per batch, with an optional
+  pause between batches. Progress is saved in the online_migration_checkpoints table in the same
+  transaction as each batch, so a backfill that is interrupted resumes where it stopped
+
+Commands (registered in app.py):
+
+    flask online upgrade            flask db upgrade with one transaction per revision and a lock timeout
+    flask online backfill ...       run a backfill outside of a revision
+    flask online progress           show saved backfill checkpoints
+    flask online seed ...           fill the database with a large generated catalog to try things on
+"""
+
+import random
+import time
+from contextlib import contextmanager
+
+import click
+from alembic import op
+from flask import current_app
+from flask.cli import AppGroup
+from flask_migrate import upgrade as migrate_upgrade
+from sqlalchemy import (
+    BigInteger, Boolean, Column, DateTime, MetaData, String, Table, and_, func, insert, literal_column, select, text, update,
+)
+
+from db import db
+
+checkpoint_metadata = MetaData()
+checkpoints = Table(
+    "online_migration_checkpoints",
+    checkpoint_metadata,
+    Column("name", String(200), primary_key=True),
+    Column("last_key", BigInteger, nullable=False),
+    Column("rows_done", BigInteger, nullable=False),
+    Column("finished", Boolean, nullable=False),
+    Column("updated_at", DateTime, nullable=False, server_default=func.now()),
+)
+
+
+class Backfill:
+    def __init__(self, engine, name, table_name, values, where=None, batch_size=1000, pause=0.0, key="id", log=print):
+        self.engine = engine
+        # Name of the checkpoint, running a backfill with the same name again resumes it
+        self.name = name
+        self.table = Table(table_name, MetaData(), autoload_with=engine)
+        self.values = values
+        self.where = where
+        self.batch_size = batch_size
+        # Seconds to sleep between batches, gives other transactions room on a busy database
+        self.pause = pause
+        self.key = self.table.c[key]
+        self.log = log
+
+    def run(self):
+        checkpoint_metadata.create_all(self.engine, checkfirst=True)
+        last_key, rows_done, finished = self._load_checkpoint()
+        if finished:
+            self.log(f"{self.name}: already finished ({rows_done} rows), skipping.")
+            return rows_done
+
+        remaining = self._count_remaining(last_key)
+        total = rows_done + remaining
+        started = time.time()
+        rows_this_run = 0
+        self.log(f"{self.name}: {remaining} rows to update in batches of {self.batch_size}, resuming after {self.key.name} {last_key}.")
+
+        while True:
+            # One short transaction per batch: the update and the checkpoint commit together
+            with self.engine.begin() as connection:
+                batch = select(self.key).where(self.key > last_key).order_by(self.key).limit(self.batch_size).subquery()
+                upper = connection.execute(select(func.max(batch.c[self.key.name]))).scalar()
+                if upper is None:
+                    self._save_checkpoint(connection, last_key, rows_done, True)
+                    break
+
+                condition = and_(self.key > last_key, self.key <= upper)
+                if self.where is not None:
+                    condition = and_(condition, self.where)
+                result = connection.execute(update(self.table).where(condition).values(self.values))
+
+                last_key = upper
+                rows_done += result.rowcount
+                rows_this_run += result.rowcount
+                self._save_checkpoint(connection, last_key, rows_done, False)
+
+            self._report(rows_done, total, rows_this_run, started)
+            if self.pause:
+                time.sleep(self.pause)
+
+        self.log(f"{self.name}: finished, {rows_done} rows updated in {time.time() - started:.1f}s.")
+        return rows_done
+
+    def _load_checkpoint(self):
+        with self.engine.connect() as connection:
+            row = connection.execute(select(checkpoints).where(checkpoints.c.name == self.name)).first()
+        if row is None:
+            return 0, 0, False
+        return row.last_key, row.rows_done, row.finished
+
+    def _save_checkpoint(self, connection, last_key, rows_done, finished):
+        values = {"last_key": last_key, "rows_done": rows_done, "finished": finished, "updated_at": func.now()}
+        result = connection.execute(update(checkpoints).where(checkpoints.c.name == self.name).values(values))
+        if result.rowcount == 0:
+            connection.execute(insert(checkpoints).values(name=self.name, **values))
+
+    def _count_remaining(self, last_key):
+        condition = self.key > last_key
+        if self.where is not None:
+            condition = and_(condition, self.where)
+        with self.engine.connect() as connection:
+            return connection.execute(select(func.count()).select_from(self.table).where(condition)).scalar()
+
+    def _report(self, rows_done, total, rows_this_run, started):
+        elapsed = time.time() - started
+        rate = rows_this_run / elapsed if elapsed else 0
+        percent = 100 * rows_done / total if total else 100
+        eta = (total - rows_done) / rate if rate else 0
+        self.log(f"{self.name}: {rows_done}/{total} rows ({percent:.1f}%), {rate:.0f} rows/s, eta {eta:.0f}s")
+
+
+# Revision helpers, called from upgrade() / downgrade() in migrations/versions
+
+def create_index_concurrently(index_name, table_name, columns, **kw):
+    context = op.get_context()
+    if context.dialect.name == "postgresql":
+        # CONCURRENTLY cannot run inside a transaction, so commit what the migration did so far first
+        with context.autocommit_block():
+            if context.as_sql:
+                op.create_index(index_name, table_name, columns, postgresql_concurrently=True, if_not_exists=True, **kw)
+                return
+            with _without_lock_timeout():
+                # IF NOT EXISTS would also skip the INVALID leftover of a failed build, drop that one first
+                if _index_valid(index_name, kw.get("schema")) is False:
+                    op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True, schema=kw.get("schema"))
+                op.create_index(index_name, table_name, columns, postgresql_concurrently=True, if_not_exists=True, **kw)
+    else:
+        op.create_index(index_name, table_name, columns, if_not_exists=True, **kw)
+
+
+# True / False for a valid / invalid index with that name, None when there is none
+def _index_valid(index_name, schema=None):
+    name = f"{schema}.{index_name}" if schema else index_name
+    return op.get_bind().execute(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {"name": name}
+    ).scalar()
+
+
+# A concurrent build only takes a lock that lets reads and writes through, but it waits for every
+# transaction already open on the table. The lock_timeout set by "flask online upgrade" is meant for
+# locks that block traffic, and would fail the build (leaving an invalid index) on any long transaction
+@contextmanager
+def _without_lock_timeout():
+    bind = op.get_bind()
+    previous = bind.execute(text("SHOW lock_timeout")).scalar()
+    bind.execute(text("SET lock_timeout = 0"))
+    try:
+        yield
+    finally:
+        bind.execute(text("SELECT set_config('lock_timeout', :timeout, false)"), {"timeout": previous})
+
+
+def drop_index_concurrently(index_name, table_name, **kw):
+    if op.get_context().dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True, **kw)
+    else:
+        op.drop_index(index_name, table_name=table_name, if_exists=True, **kw)
+
+
+def backfill(name, table_name, values, where=None, **options):
+    context = op.get_context()
+    if context.as_sql:
+        # Offline (--sql) mode can only print SQL, so emit the whole update as one statement
+        table = Table(table_name, MetaData(), *(Column(column) for column in values))
+        statement = update(table).values(values)
+        op.execute(statement if where is None else statement.where(where))
+        return
+
+    # Commit the schema changes made so far (e.g. the new column), then let each batch commit on its own
+    with context.autocommit_block():
+        Backfill(op.get_bind().engine, name, table_name, values, where, **options).run()
+
+
+# "flask online" commands
+
+online_cli = AppGroup("online", help="Zero-downtime migration tools for large tables.")
+
+
+@online_cli.command("upgrade")
+@click.option("--lock-timeout", default="5s", show_default=True, help="Postgres lock_timeout for DDL, so a migration waiting on a lock fails instead of blocking every query behind it.")
+def upgrade_command(lock_timeout):
+    """flask db upgrade, committing after each revision instead of once at the end."""
+    current_app.extensions["migrate"].configure_args["transaction_per_migration"] = True
+    # Read by migrations/env.py
+    current_app.config["MIGRATION_LOCK_TIMEOUT"] = lock_timeout
+    migrate_upgrade()
+
+
+@online_cli.command("backfill")
+@click.argument("table_name")
+@click.option("--name", required=True, help="Checkpoint name, use the same name to resume.")
+@click.option("--set", "assignments", multiple=True, required=True, help='Column assignment as column=SQL expression, e.g. "price=price * 0.9".')
+@click.option("--where", default=None, help="Optional SQL condition limiting the rows updated.")
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option("--pause", default=0.0, show_default=True, help="Seconds to wait between batches.")
+def backfill_command(table_name, name, assignments, where, batch_size, pause):
+    """Update a large table in batches, resuming from the last checkpoint."""
+    values = {}
+    for assignment in assignments:
+        column, _, expression = assignment.partition("=")
+        values[column.strip()] = literal_column(expression.strip())
+    Backfill(
+        db.engine, name, table_name, values,
+        where=text(where) if where else None,
+        batch_size=batch_size, pause=pause, log=click.echo,
+    ).run()
+
+
+@online_cli.command("progress")
+def progress_command():
+    """Show the saved backfill checkpoints."""
+    checkpoint_metadata.create_all(db.engine, checkfirst=True)
+    with db.engine.connect() as connection:
+        for row in connection.execute(select(checkpoints).order_by(checkpoints.c.name)):
+            state = "finished" if row.finished else "in progress"
+            click.echo(f"{row.name}: {state}, {row.rows_done} rows, last key {row.last_key}, updated {row.updated_at}")
+
+
+@online_cli.command("seed")
+@click.option("--stores", default=100, show_default=True)
+@click.option("--items", default=1_000_000, show_default=True)
+@click.option("--tags", default=1_000, show_default=True)
+@click.option("--links-per-item", default=2, show_default=True)
+@click.option("--chunk-size", default=10_000, show_default=True)
+def seed_command(stores, items, tags, links_per_item, chunk_size):
+    """Fill the database with a generated catalog, to try migrations on a large dataset."""
+    from models import StoreModel, ItemModel, TagModel, ItemsTags
+
+    # Bulk inserts with explicit ids bypass the shard routing (every shard would get every row),
+    # and the migration helpers only work on the main database anyway
+    if hasattr(current_app, "shard_router"):
+        raise click.ClickException("seed does not support sharding, unset SHARD_DATABASE_URLS to run it")
+
+    def insert_chunks(model, rows):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                db.session.execute(insert(model), chunk)
+                db.session.commit()
+                chunk = []
+        if chunk:
+            db.session.execute(insert(model), chunk)
+            db.session.commit()
+
+    # Offset names and ids so seeding twice does not clash with what is already there
+    run = int(time.time())
+    first_store = (db.session.execute(select(func.max(StoreModel.id))).scalar() or 0) + 1
+    first_item = (db.session.execute(select(func.max(ItemModel.id))).scalar() or 0) + 1
+    first_tag = (db.session.execute(select(func.max(TagModel.id))).scalar() or 0) + 1
+    store_ids = range(first_store, first_store + stores)
+
+    insert_chunks(StoreModel, ({"id": store_id, "name": f"store-{run}-{store_id}"} for store_id in store_ids))
+    # Tags are spread over the stores, and each item is linked to tags of its own store
+    tag_store = {first_tag + n: store_ids[n % stores] for n in range(tags)}
+    insert_chunks(TagModel, ({"id": tag_id, "name": f"tag-{run}-{tag_id}", "store_id": store_id} for tag_id, store_id in tag_store.items()))
+    click.echo(f"Inserted {stores} stores and {tags} tags.")
+
+    def item_store(item_id):
+        return store_ids[item_id % stores]
+
+    insert_chunks(ItemModel, (
+        {"id": item_id, "name": f"item-{item_id}", "price": round(random.uniform(1, 100), 2), "store_id": item_store(item_id)}
+        for item_id in range(first_item, first_item + items)
+    ))
+    click.echo(f"Inserted {items} items.")
+
+    tags_by_store = {}
+    for tag_id, store_id in tag_store.items():
+        tags_by_store.setdefault(store_id, []).append(tag_id)
+
+    def links():
+        for item_id in range(first_item, first_item + items):
+            store_tags = tags_by_store.get(item_store(item_id), [])
+            for tag_id in random.sample(store_tags, min(links_per_item, len(store_tags))):
+                yield {"item_id": item_id, "tag_id": tag_id}
+
+    insert_chunks(ItemsTags, links())
+    click.echo(f"Inserted up to {items * links_per_item} item tag links.")
+
+    # The ids above were given explicitly, which does not advance Postgres' SERIAL sequences
+    # Move them past the seeded rows, or the next store, item or tag created by the app would reuse an id
+    if db.session.get_bind().dialect.name == "postgresql":
+        for model in (StoreModel, TagModel, ItemModel):
+            sequence = func.pg_get_serial_sequence(model.__tablename__, "id")
+            db.session.execute(select(func.setval(sequence, select(func.max(model.id)).scalar_subquery())))
+        db.session.commit()
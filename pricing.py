@@ -0,0 +1,113 @@
+"""
+pricing.py
+
+Set-based repricing for POST /item/reprice (resources/item.py).
+
+A rule is a percentage and/or an absolute change, then rounding to a step:
+
+    {"percent": -10, "round_to": 0.05}      10% off, rounded to the nearest 0.05
+    {"amount": 2, "min_price": 1}           2 more on every price, never below 1
+
+The new price is computed by the database, new = round((price * (1 + percent / 100) + amount) / round_to) * round_to,
+with the same SQL expression for the preview and the update, so a dry run shows exactly what the update writes.
+
+The update runs in primary key chunks, one UPDATE ... WHERE id > last AND id <= chunk end per chunk, each
+committed on its own so a large repricing never holds row locks on the whole items table.
+"""
+
+from decimal import Decimal
+
+from sqlalchemy import Numeric, case, cast, func, literal, select, update
+
+from db import db
+from models import ItemModel, ItemsTags
+
+
+class PriceRule:
+    def __init__(self, percent=0, amount=0, round_to=0.01, min_price=0):
+        self.percent = percent
+        self.amount = amount
+        self.round_to = round_to
+        self.min_price = min_price
+
+    # New price as a SQL expression of the current one
+    def expression(self, price=ItemModel.price):
+        # Calculate in NUMERIC, values bound as the price column type would be single precision (real) on Postgres
+        factor = self._numeric(1 + Decimal(str(self.percent)) / 100)
+        step = Decimal(str(self.round_to))
+        adjusted = cast(price, Numeric) * factor + self._numeric(self.amount)
+        # Round to the step, then to the step's decimals to drop float noise (12.350000000000001)
+        digits = max(0, -step.normalize().as_tuple().exponent)
+        rounded = func.round(func.round(adjusted / self._numeric(step)) * self._numeric(step), digits)
+        min_price = self._numeric(self.min_price)
+        return case((rounded < min_price, min_price), else_=rounded)
+
+    @staticmethod
+    def _numeric(value):
+        return literal(Decimal(str(value)), Numeric)
+
+
+# WHERE clause for the items a repricing applies to
+def item_filter(store_id=None, tag_id=None, min_id=None, max_id=None):
+    conditions = []
+    if store_id is not None:
+        conditions.append(ItemModel.store_id == store_id)
+    if tag_id is not None:
+        conditions.append(ItemModel.id.in_(select(ItemsTags.item_id).where(ItemsTags.tag_id == tag_id)))
+    if min_id is not None:
+        conditions.append(ItemModel.id >= min_id)
+    if max_id is not None:
+        conditions.append(ItemModel.id <= max_id)
+    return conditions
+
+
+# Count, totals and the first rows of a repricing, computed by one SELECT without writing anything
+def preview(rule, conditions, limit=20):
+    new_price = rule.expression()
+    # One row per database when sharded (see sharding.py), so add them up
+    totals = db.session.execute(
+        select(func.count(), func.sum(ItemModel.price), func.sum(new_price)).where(*conditions)
+    ).all()
+    sample = db.session.execute(
+        select(ItemModel.id, ItemModel.name, ItemModel.price, new_price.label("new_price"))
+        .where(*conditions).order_by(ItemModel.id).limit(limit)
+    ).all()
+    sample = sorted(sample, key=lambda row: row.id)[:limit]
+    return {
+        "matched": sum(row[0] for row in totals),
+        "total_before": round(sum(float(row[1] or 0) for row in totals), 2),
+        "total_after": round(sum(float(row[2] or 0) for row in totals), 2),
+        "sample": [
+            {"id": row.id, "name": row.name, "price": row.price, "new_price": float(row.new_price)}
+            for row in sample
+        ],
+    }
+
+
+# Apply the rule chunk by chunk, returns (rows updated, chunks, ids of the stores touched)
+def reprice(rule, conditions, chunk_size=1000):
+    store_ids = set(db.session.execute(select(ItemModel.store_id).where(*conditions).distinct()).scalars())
+    last_id = 0
+    updated = 0
+    chunks = 0
+    while True:
+        chunk_ids = db.session.execute(
+            select(ItemModel.id).where(*conditions, ItemModel.id > last_id).order_by(ItemModel.id).limit(chunk_size)
+        ).scalars().all()
+        if not chunk_ids:
+            break
+        chunk_end = max(chunk_ids)
+
+        result = db.session.execute(
+            update(ItemModel)
+            .where(*conditions, ItemModel.id > last_id, ItemModel.id <= chunk_end)
+            .values(price=rule.expression())
+            # Rows are not loaded into the session, loaded items are expired by the commit
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+        last_id = chunk_end
+        updated += result.rowcount
+        chunks += 1
+    return updated, chunks, store_ids
@@ -0,0 +1,184 @@
+"""
+profiler.py
+
+On-demand profiler for a running worker, driven by the admin endpoints in resources/profiler.py.
+
+A profiling session covers a time window and/or the next N requests whose path matches a
+regex. While it runs, the app's wsgi_app is wrapped so each matching request is:
+- profiled with cProfile (exact call counts and times, merged into one pstats report)
+- sampled by a background thread reading the request thread's stack every few milliseconds,
+  giving collapsed stacks ("frame;frame;frame count") for flamegraph.pl or speedscope
+
+Stacks include everything the request runs through: the Flask dispatch, SQLAlchemy and marshmallow.
+
+When no session is running, app.wsgi_app is the original one, so there is no overhead at all.
+Sessions are per worker: with several gunicorn workers only the worker that received the
+start request is profiled.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+# Longest time window a session can ask for, and when a session limited only by requests ends on its own
+MAX_SESSION_SECONDS = 300
+
+
+class ProfileSession:
+    def __init__(self, seconds=None, requests=None, route=None, interval=0.005):
+        self.route = re.compile(route) if route else None
+        self.max_requests = requests
+        self.deadline = time.time() + (seconds or MAX_SESSION_SECONDS)
+        self.interval = interval
+
+        self.started = time.time()
+        self.finished = None
+        self.requests_profiled = 0
+        self.samples = Counter()
+        self.stats = None
+
+        self._lock = threading.Lock()
+        # Threads currently inside a profiled request
+        self._threads = set()
+
+    @property
+    def running(self):
+        return self.finished is None
+
+    def matches(self, path):
+        return self.route is None or self.route.match(path) is not None
+
+    # Reserve a slot for a request, False once the session is done or out of requests
+    def begin_request(self):
+        with self._lock:
+            if not self.running or time.time() >= self.deadline:
+                return False
+            if self.max_requests is not None and self.requests_profiled >= self.max_requests:
+                return False
+            self.requests_profiled += 1
+            self._threads.add(threading.get_ident())
+            return True
+
+    def end_request(self, profile):
+        with self._lock:
+            self._threads.discard(threading.get_ident())
+            if profile is not None:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+            done = self.max_requests is not None and self.requests_profiled >= self.max_requests
+        return done and not self._threads
+
+    def sample(self):
+        with self._lock:
+            threads = list(self._threads)
+        frames = sys._current_frames()
+        for ident in threads:
+            frame = frames.get(ident)
+            if frame is not None:
+                self.samples[collapse(frame)] += 1
+
+    # Collapsed stacks, one "frame;frame;frame count" line per distinct stack
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+    def cprofile_report(self, sort="cumulative", limit=50):
+        if self.stats is None:
+            return ""
+        output = io.StringIO()
+        self.stats.stream = output
+        self.stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def summary(self):
+        return {
+            "running": self.running,
+            "route": self.route.pattern if self.route else None,
+            "max_requests": self.max_requests,
+            "requests_profiled": self.requests_profiled,
+            "samples": sum(self.samples.values()),
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+# Turn a frame into a collapsed stack, outermost call first
+def collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class Profiler:
+    def __init__(self, app):
+        self.app = app
+        self.session = None
+        self._original_wsgi_app = None
+        self._lock = threading.Lock()
+
+    def start(self, **options):
+        with self._lock:
+            if self.session is not None and self.session.running:
+                return None
+            session = ProfileSession(**options)
+            self.session = session
+            self._original_wsgi_app = self.app.wsgi_app
+            self.app.wsgi_app = self._wrap(self._original_wsgi_app, session)
+        threading.Thread(target=self._sampler, args=(session,), daemon=True).start()
+        return session
+
+    # Stops the running session, or only that session if one is given
+    def stop(self, session=None):
+        with self._lock:
+            if session is not None and session is not self.session:
+                return session
+            session = self.session
+            if session is None or not session.running:
+                return session
+            session.finished = time.time()
+            # Put the original wsgi_app back so requests run without any profiling code again
+            # (it is usually the Flask class method, in which case dropping the override is enough)
+            if self._original_wsgi_app == type(self.app).wsgi_app.__get__(self.app):
+                del self.app.wsgi_app
+            else:
+                self.app.wsgi_app = self._original_wsgi_app
+            self._original_wsgi_app = None
+        return session
+
+    def _wrap(self, wsgi_app, session):
+        def profiled_wsgi_app(environ, start_response):
+            if not session.matches(environ.get("PATH_INFO", "")) or not session.begin_request():
+                return wsgi_app(environ, start_response)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ only allows one active cProfile at a time, the request is still sampled
+                profile = None
+            try:
+                return wsgi_app(environ, start_response)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                if session.end_request(profile):
+                    self.stop()
+        return profiled_wsgi_app
+
+    def _sampler(self, session):
+        # Whatever happens to the sampler, the profiling wrapper must not stay installed
+        try:
+            while session.running and time.time() < session.deadline:
+                session.sample()
+                time.sleep(session.interval)
+        finally:
+            self.stop(session)
@@ -0,0 +1,217 @@
+"""
+ratelimit.py
+
+Admission control for the API, registered on the app in create_app:
+
+- Load shedding: when this worker already has too many requests in flight, or every connection
+  in the database pool is checked out (so the next query would have to wait), new requests get
+  a 503 with Retry-After straight away instead of queueing and dragging tail latency up for everyone.
+  (In-flight limits matter with threaded or gevent workers, a sync worker only runs one request.)
+- Rate limiting: a token bucket per client and blueprint. Clients are keyed by JWT identity when
+  a valid token is sent, otherwise by IP. Buckets live in redis (one atomic Lua script per check)
+  so all workers share them, with an in-process fallback used while redis is unreachable.
+
+The IP is the address of the connection (request.remote_addr), X-Forwarded-For is only trusted for
+the number of proxies given in PROXY_FIX_X_FOR (applied with werkzeug's ProxyFix in create_app).
+Otherwise any client could pick a new IP, and a new bucket, for every request.
+
+With SERVER_MODE=asgi the GET routes answered by asgi.py never reach the flask hooks below, so
+AsyncReadApp runs the same checks through enter(), leave(), overloaded() and limit().
+
+Budgets are "capacity/seconds", e.g. "20/60" is a burst of 20 requests refilled over 60 seconds.
+Override them with RATE_LIMIT_<BLUEPRINT NAME>, e.g. RATE_LIMIT_USERS=10/60 or RATE_LIMIT_DEFAULT=200/10.
+"""
+
+import math
+import os
+import threading
+import time
+
+from flask import jsonify, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from redis.exceptions import RedisError
+from sqlalchemy.pool import QueuePool
+
+from db import db
+
+# Budgets per blueprint name, "default" covers every blueprint without its own entry
+# The users blueprint (login, register) is the tightest, each login runs pbkdf2 on the CPU
+DEFAULT_BUDGETS = {
+    "default": "100/10",
+    "Users": "20/60",
+}
+
+# Takes tokens from a bucket if it has enough, refilling it for the time since the last request
+# Returns {allowed, milliseconds until enough tokens are available}
+TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local refill_per_ms = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * refill_per_ms)
+
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = math.ceil((cost - tokens) / refill_per_ms)
+end
+
+redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(capacity / refill_per_ms) + 1000)
+return {allowed, retry_after}
+"""
+
+# After redis fails, use the local buckets for this long before trying redis again
+REDIS_RETRY_SECONDS = 30
+
+# Local buckets kept before idle (fully refilled) ones are dropped
+MAX_LOCAL_BUCKETS = 10000
+
+
+# Error bodies, also sent by asgi.py
+OVERLOADED = {"message": "Server is overloaded, try again shortly.", "error": "overloaded"}
+RATE_LIMITED = {"message": "Too many requests.", "error": "rate_limited"}
+
+
+def parse_budget(budget):
+    capacity, seconds = budget.split("/")
+    capacity = float(capacity)
+    return capacity, capacity / (float(seconds) * 1000)
+
+
+# Client address as werkzeug's ProxyFix(x_for=trusted_proxies) works it out, for asgi.py
+# The last trusted_proxies entries of X-Forwarded-For were added by our own proxies, the one before them is the client
+def forwarded_address(remote_addr, forwarded_for, trusted_proxies):
+    if trusted_proxies and forwarded_for:
+        addresses = [address.strip() for address in forwarded_for.split(",")]
+        if len(addresses) >= trusted_proxies:
+            return addresses[-trusted_proxies]
+    return remote_addr
+
+
+class RateLimiter:
+    def __init__(self, app, redis_connection=None):
+        self.redis = redis_connection
+        self.enabled = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+        self.max_in_flight = int(os.getenv("MAX_IN_FLIGHT", "0"))
+        self.shed_on_pool_exhaustion = os.getenv("SHED_ON_DB_POOL_EXHAUSTION", "1") == "1"
+
+        self.budgets = {
+            name: parse_budget(os.getenv(f"RATE_LIMIT_{name.upper()}", budget))
+            for name, budget in DEFAULT_BUDGETS.items()
+        }
+        self._script = redis_connection.register_script(TOKEN_BUCKET) if redis_connection is not None else None
+        self._redis_down_until = 0
+
+        self._lock = threading.Lock()
+        self._local_buckets = {}
+        self._in_flight = 0
+
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+
+    def before_request(self):
+        self.enter()
+        # Mark the request so teardown only decrements for requests counted here
+        request.environ["ratelimit.counted"] = True
+
+        if self.overloaded():
+            return self.error(503, OVERLOADED["message"], OVERLOADED["error"], 1)
+
+        if self.enabled:
+            retry_after = self.limit(request.blueprint or "default", self.client_key())
+            if retry_after is not None:
+                return self.error(429, RATE_LIMITED["message"], RATE_LIMITED["error"], retry_after)
+        return None
+
+    def teardown_request(self, exception):
+        if request.environ.pop("ratelimit.counted", False):
+            self.leave()
+
+    # In-flight requests of this worker, counted for the flask app and asgi.py alike
+    def enter(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    # Takes a token from the client's bucket for the blueprint, returns the seconds to wait when there is none
+    def limit(self, blueprint, client):
+        capacity, refill_per_ms = self.budget(blueprint)
+        allowed, retry_after_ms = self.take(f"ratelimit:{blueprint}:{client}", capacity, refill_per_ms)
+        return None if allowed else math.ceil(retry_after_ms / 1000)
+
+    def budget(self, blueprint):
+        if blueprint not in self.budgets:
+            override = os.getenv(f"RATE_LIMIT_{blueprint.upper()}")
+            self.budgets[blueprint] = parse_budget(override) if override else self.budgets["default"]
+        return self.budgets[blueprint]
+
+    # pool is the connection pool the request will use, the flask app's by default
+    def overloaded(self, pool=None):
+        if self.max_in_flight and self._in_flight > self.max_in_flight:
+            return True
+        if self.shed_on_pool_exhaustion:
+            pool = pool or db.engine.pool
+            # Every connection (including overflow) is in use, this request would wait for one
+            if isinstance(pool, QueuePool) and pool._max_overflow >= 0 and pool.checkedout() >= pool.size() + pool._max_overflow:
+                return True
+        return False
+
+    # JWT identity if the request carries a valid token, otherwise the client IP
+    def client_key(self):
+        if request.headers.get("Authorization"):
+            try:
+                verify_jwt_in_request(optional=True)
+                identity = get_jwt_identity()
+                if identity is not None:
+                    return f"user:{identity}"
+            except Exception:
+                # Invalid or expired tokens are rejected by the view itself, count them against the IP
+                pass
+        return f"ip:{request.remote_addr}"
+
+    def take(self, key, capacity, refill_per_ms, cost=1):
+        now = int(time.time() * 1000)
+        if self._script is not None and now >= self._redis_down_until:
+            try:
+                allowed, retry_after_ms = self._script(keys=[key], args=[capacity, refill_per_ms, now, cost])
+                return bool(allowed), retry_after_ms
+            except RedisError:
+                self._redis_down_until = now + REDIS_RETRY_SECONDS * 1000
+        return self.take_local(key, capacity, refill_per_ms, now, cost)
+
+    # Same algorithm as the Lua script, for this worker only
+    def take_local(self, key, capacity, refill_per_ms, now, cost=1):
+        with self._lock:
+            if len(self._local_buckets) > MAX_LOCAL_BUCKETS:
+                self.prune_local(now)
+            tokens, ts, _full_at = self._local_buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + max(0, now - ts) * refill_per_ms)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            # Also keep when the bucket will be full again, so idle buckets can be pruned
+            self._local_buckets[key] = (tokens, now, now + (capacity - tokens) / refill_per_ms)
+            return allowed, 0 if allowed else math.ceil((cost - tokens) / refill_per_ms)
+
+    # Drop buckets that have been idle long enough to be full again, they are the same as no bucket
+    def prune_local(self, now):
+        idle = {key for key, (_tokens, _ts, full_at) in self._local_buckets.items() if now >= full_at}
+        for key in idle:
+            del self._local_buckets[key]
+
+    def error(self, status, message, error, retry_after):
+        response = jsonify({"message": message, "error": error})
+        response.status_code = status
+        response.headers["Retry-After"] = str(max(1, retry_after))
+        return response
@@ -0,0 +1,186 @@
+"""
+reads.py
+
+Read-only query layer for the list endpoints: GET /item, GET /store and GET /store/<id>/tag.
+
+Loading ORM instances only to dump them to JSON straight away costs a lot per row: identity map
+bookkeeping, attribute instrumentation, lazy relationship loaders. Here the same data comes from
+plain select()s of columns, fetched batch by batch, and the nested store/tag/item structure is
+put together from small __slots__ records that the response schemas dump like model instances.
+
+Each endpoint runs a fixed number of queries (one per table involved, IN lists split into chunks),
+whatever the number of rows. Columns are selected through the models (ItemModel.id, ...) so the
+queries still route to the right databases when sharding is on (see sharding.py). A query that
+fans out to several shards returns each shard's rows one after the other, so ORDER BY only sorts
+within a shard: items() and stores() sort what they assembled by id at the end. Nested lists need
+nothing more, an item's tags and a store's items and tags all live on one shard.
+
+bench_reads.py compares CPU time and peak memory with the ORM path.
+"""
+
+from sqlalchemy import select
+
+from db import db
+from models import StoreModel, ItemModel, TagModel, ItemsTags
+
+# Rows fetched from the cursor at a time
+BATCH_SIZE = 1000
+
+# Ids per IN (...) list, below the bound parameter limits of sqlite and Postgres
+IN_CHUNK = 500
+
+
+# Records with the attributes the response schemas read, much smaller than model instances
+class PlainRecord:
+    __slots__ = ("id", "name")
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class PlainItemRecord:
+    __slots__ = ("id", "name", "price")
+
+    def __init__(self, id, name, price):
+        self.id = id
+        self.name = name
+        self.price = price
+
+
+class ItemRecord:
+    __slots__ = ("id", "name", "price", "store", "tags")
+
+    def __init__(self, id, name, price, store):
+        self.id = id
+        self.name = name
+        self.price = price
+        self.store = store
+        self.tags = []
+
+
+class StoreRecord:
+    __slots__ = ("id", "name", "items", "tags")
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.items = []
+        self.tags = []
+
+
+class TagRecord:
+    __slots__ = ("id", "name", "store", "items")
+
+    def __init__(self, id, name, store):
+        self.id = id
+        self.name = name
+        self.store = store
+        self.items = []
+
+
+# Rows of a select, fetched BATCH_SIZE at a time (a server side cursor on Postgres)
+def _rows(statement):
+    result = db.session.execute(statement.execution_options(yield_per=BATCH_SIZE))
+    for partition in result.partitions():
+        yield from partition
+
+
+# Rows of a select for every chunk of ids, or one select without the IN when ids is None
+def _rows_in(statement, column, ids):
+    if ids is None:
+        yield from _rows(statement)
+        return
+    ids = sorted(set(ids))
+    for start in range(0, len(ids), IN_CHUNK):
+        yield from _rows(statement.where(column.in_(ids[start:start + IN_CHUNK])))
+
+
+# Same shape as ItemSchema: each item with its store and tags
+def items(ids=None):
+    records = [
+        ItemRecord(item_id, name, price, store_id)
+        for item_id, name, price, store_id in _rows_in(
+            select(ItemModel.id, ItemModel.name, ItemModel.price, ItemModel.store_id).order_by(ItemModel.id),
+            ItemModel.id, ids,
+        )
+    ]
+    if not records:
+        return records
+
+    # One shared store record per store rather than one per item
+    store_ids = {record.store for record in records}
+    stores = {
+        store_id: PlainRecord(store_id, name)
+        for store_id, name in _rows_in(select(StoreModel.id, StoreModel.name), StoreModel.id, None if ids is None else store_ids)
+    }
+    by_id = {}
+    for record in records:
+        record.store = stores.get(record.store)
+        by_id[record.id] = record
+
+    tags = {}
+    links = select(ItemsTags.item_id, TagModel.id, TagModel.name).join(TagModel, TagModel.id == ItemsTags.tag_id).order_by(TagModel.id)
+    for item_id, tag_id, name in _rows_in(links, ItemsTags.item_id, ids):
+        record = by_id.get(item_id)
+        if record is not None:
+            tag = tags.get(tag_id)
+            if tag is None:
+                tag = tags[tag_id] = PlainRecord(tag_id, name)
+            record.tags.append(tag)
+    records.sort(key=lambda record: record.id)
+    return records
+
+
+# Same shape as StoreSchema: each store with its items and tags
+def stores(ids=None):
+    records = [
+        StoreRecord(store_id, name)
+        for store_id, name in _rows_in(select(StoreModel.id, StoreModel.name).order_by(StoreModel.id), StoreModel.id, ids)
+    ]
+    if not records:
+        return records
+    by_id = {record.id: record for record in records}
+    store_ids = None if ids is None else list(by_id)
+
+    item_rows = select(ItemModel.id, ItemModel.name, ItemModel.price, ItemModel.store_id).order_by(ItemModel.id)
+    for item_id, name, price, store_id in _rows_in(item_rows, ItemModel.store_id, store_ids):
+        if store_id in by_id:
+            by_id[store_id].items.append(PlainItemRecord(item_id, name, price))
+
+    tag_rows = select(TagModel.id, TagModel.name, TagModel.store_id).order_by(TagModel.id)
+    for tag_id, name, store_id in _rows_in(tag_rows, TagModel.store_id, store_ids):
+        if store_id in by_id:
+            by_id[store_id].tags.append(PlainRecord(tag_id, name))
+    records.sort(key=lambda record: record.id)
+    return records
+
+
+# Same shape as TagSchema: the store's tags, each with the store and its items
+# None when the store does not exist
+def store_tags(store_id):
+    store = db.session.execute(select(StoreModel.id, StoreModel.name).where(StoreModel.id == store_id)).first()
+    if store is None:
+        return None
+    store = PlainRecord(*store)
+
+    records = [
+        TagRecord(tag_id, name, store)
+        for tag_id, name in _rows(select(TagModel.id, TagModel.name).where(TagModel.store_id == store_id).order_by(TagModel.id))
+    ]
+    by_id = {record.id: record for record in records}
+
+    links = (
+        select(ItemsTags.tag_id, ItemModel.id, ItemModel.name, ItemModel.price)
+        .join(ItemModel, ItemModel.id == ItemsTags.item_id)
+        .where(ItemModel.store_id == store_id)
+        .order_by(ItemModel.id)
+    )
+    items_by_id = {}
+    for tag_id, item_id, name, price in _rows(links):
+        if tag_id in by_id:
+            item = items_by_id.get(item_id)
+            if item is None:
+                item = items_by_id[item_id] = PlainItemRecord(item_id, name, price)
+            by_id[tag_id].items.append(item)
+    return records
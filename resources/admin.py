@@ -0,0 +1,9 @@
+from flask_smorest import abort
+from flask_jwt_extended import get_jwt
+
+
+# Admin check for the operational endpoints, based on the is_admin claim added in app.py
+# Call it inside a view protected by @jwt_required()
+def require_admin():
+    if not get_jwt().get("is_admin"):
+        abort(401, message="Admin privilege required.")
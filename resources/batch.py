@@ -0,0 +1,74 @@
+import re
+
+from flask.views import MethodView
+from flask_smorest import Blueprint
+from flask_jwt_extended import jwt_required
+from sqlalchemy.orm import selectinload
+
+from models import TagModel
+from schemas import ItemSchema, StoreSchema, TagSchema
+from schemas import BatchRequestSchema, BatchResponseSchema
+import reads
+
+blp = Blueprint("batch", __name__, description="Run several read requests in one call")
+
+
+# Loaders return {id: row} for the requested ids, with a fixed number of queries whatever the number of ids
+# Items and stores come from reads.py (StoreModel's dynamic relationships would cost two queries per store)
+def load_items(ids):
+    return {record.id: record for record in reads.items(ids)}
+
+def load_stores(ids):
+    return {record.id: record for record in reads.stores(ids)}
+
+def load_tags(ids):
+    query = TagModel.query.options(selectinload(TagModel.store), selectinload(TagModel.items))
+    return {tag.id: tag for tag in query.filter(TagModel.id.in_(ids)).all()}
+
+
+# The GET paths a batch can contain, with the loader and schema used to answer them
+BATCH_ROUTES = [
+    (re.compile(r"^/item/(\d+)$"), load_items, ItemSchema()),
+    (re.compile(r"^/store/(\d+)$"), load_stores, StoreSchema()),
+    (re.compile(r"^/tags/(\d+)$"), load_tags, TagSchema()),
+]
+
+
+@blp.route("/batch")
+class Batch(MethodView):
+    # The JWT is verified once for the whole batch instead of once per sub-request
+    @jwt_required()
+    @blp.arguments(BatchRequestSchema)
+    @blp.response(200, BatchResponseSchema)
+    def post(self, batch_data):
+        # First pass: work out which route each sub-request matches and collect the ids per model
+        matched = []
+        ids_by_route = {}
+        for sub_request in batch_data["requests"]:
+            route = None
+            if sub_request["method"].upper() == "GET":
+                for index, (pattern, *_rest) in enumerate(BATCH_ROUTES):
+                    match = pattern.match(sub_request["path"])
+                    if match:
+                        route = (index, int(match.group(1)))
+                        ids_by_route.setdefault(index, set()).add(route[1])
+                        break
+            matched.append((sub_request["path"], route))
+
+        # Second pass: one load per resource type
+        found = {index: BATCH_ROUTES[index][1](ids) for index, ids in ids_by_route.items()}
+
+        # Answer the sub-requests in the order they were sent
+        responses = []
+        for path, route in matched:
+            if route is None:
+                responses.append({"path": path, "status": 400, "body": {"message": "Only GET /item/<id>, /store/<id> and /tags/<id> can be batched."}})
+                continue
+            index, resource_id = route
+            row = found[index].get(resource_id)
+            if row is None:
+                responses.append({"path": path, "status": 404, "body": {"code": 404, "status": "Not Found"}})
+            else:
+                responses.append({"path": path, "status": 200, "body": BATCH_ROUTES[index][2].dump(row)})
+
+        return {"responses": responses}
@@ -1,3 +1,4 @@
+from flask import current_app, jsonify
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
 from sqlalchemy.exc import SQLAlchemyError
@@ -8,7 +9,12 @@ from db import db
 from models import ItemModel
 
 # Import Schema
-from schemas import ItemSchema, ItemUpdateSchema
+from schemas import ItemSchema, ItemUpdateSchema, MultiGetArgsSchema, RepriceSchema
+
+from coalesce import store_keys
+from pricing import PriceRule, item_filter, preview, reprice
+from resources.admin import require_admin
+import reads
 
 # A blueprint is an object that allows defining application functions without requiring an application object ahead of time
 # Blueprints record operations to be executed later when you register them on an application (blp arguments)
@@ -29,6 +35,10 @@ class Item(MethodView):
     # self represents the instance of class. This handy keyword allows you to access variables, attributes, and methods of a defined class in Python.
     # item_id is included as a parameter to this request because it is defined in <> within the route
     def get(self, item_id):
+        # Serve from the shared catalog snapshot when it is enabled (see snapshot.py)
+        if current_app.catalog is not None:
+            return jsonify(current_app.catalog.item_or_404(item_id))
+
         # Flask SQLAlchemy allows us to perform a get query on our ItemModel
         # If the get query fails we get a 404 error
         item = ItemModel.query.get_or_404(item_id) # Retrieves item by primary key or will give 404 error
@@ -53,6 +63,9 @@ class Item(MethodView):
         db.session.delete(item)
         # Write to database (save to disk)
         db.session.commit()
+        # The store page lists its items, so drop any cached copy of it
+        current_app.coalescer.invalidate(*store_keys(item.store_id))
+        current_app.tag_bitmaps.invalidate(item.store_id)
 
         # We then return a message to the client, due to the query we will also get a 202 success message
         return {"message": "Item deleted."}
@@ -69,6 +82,7 @@ class Item(MethodView):
         # Perform a get query using the item_id to get the ItemModel
         # We removed the get_or_404 to allow for the if statement to run if the get_or_404 error fails
         item = ItemModel.query.get(item_id)
+        created = item is None
         # If item exists we update in the database, otherwise we add it
         if item:
             # Update the ItemModel price with the json payloads price
@@ -83,6 +97,10 @@ class Item(MethodView):
         db.session.add(item)
         # Write to database (save to disk)
         db.session.commit()
+        current_app.coalescer.invalidate(*store_keys(item.store_id))
+        # A new item changes the store's tag bitmaps, a name or price change does not
+        if created:
+            current_app.tag_bitmaps.invalidate(item.store_id)
 
         # We then return the item model with a 201 success message to show what was inserted to the client
         return item
@@ -92,14 +110,19 @@ class Item(MethodView):
 class ItemList(MethodView):
     # Add authentication: user must be created, then have a token created with login endpoint
     @jwt_required()
+    # Optional ?ids=1,2,3 query string to fetch only those items
+    @blp.arguments(MultiGetArgsSchema, location="query")
     # Get request returns data, validated by marshmallow using the response decorator (200 meaning OK)
     # Many set to True because we are returning multiple items
     @blp.response(200, ItemSchema(many=True)) 
     # Defining a get request
-    def get(self):
-        # Flask SQLAlchemy allows us to perform an all query on our ItemModel
-        # all method will go through every item in list where list was created by selecting many=True in ItemSchema
-        return ItemModel.query.all()
+    def get(self, query_args):
+        if current_app.catalog is not None:
+            return jsonify(current_app.catalog.items(query_args.get("ids")))
+
+        # Plain rows assembled into records instead of ORM instances, one query each for items, stores and tags (see reads.py)
+        # With ?ids=1,2,3 only those items are fetched, with IN queries instead of one GET /item/<id> per item
+        return reads.items(query_args.get("ids"))
 
     # Add in authentication
     # Cannot call this endpoint unless jwt provided
@@ -127,6 +150,52 @@ class ItemList(MethodView):
         # per ItemModel class which notes store_id nullable = False
         except SQLAlchemyError:
             abort(500, message="An error occurred while inserting the item.")
+        current_app.coalescer.invalidate(*store_keys(item.store_id))
+        current_app.tag_bitmaps.invalidate(item.store_id)
 
         # We then return the item model with a 201 success message to show what was inserted to the client
-        return item
\ No newline at end of file
+        return item
+
+# Bulk repricing: apply a pricing rule to every item matching a store, tag or id range filter
+# Runs as set-based UPDATEs in chunks instead of a PUT /item/<id> per item (see pricing.py)
+@blp.route("/item/reprice")
+class ItemReprice(MethodView):
+    @jwt_required(fresh=True)
+    @blp.arguments(RepriceSchema)
+    def post(self, reprice_data):
+        require_admin()
+
+        conditions = item_filter(
+            store_id=reprice_data.get("store_id"),
+            tag_id=reprice_data.get("tag_id"),
+            min_id=reprice_data.get("min_id"),
+            max_id=reprice_data.get("max_id"),
+        )
+        # Refuse to reprice the whole catalog by accident
+        if not conditions:
+            abort(400, message="Provide store_id, tag_id, min_id or max_id to select the items to reprice.")
+
+        rule = PriceRule(
+            percent=reprice_data["percent"],
+            amount=reprice_data["amount"],
+            round_to=reprice_data["round_to"],
+            min_price=reprice_data["min_price"],
+        )
+
+        # Dry run: compute the new prices in one SELECT and write nothing
+        if reprice_data["dry_run"]:
+            return {"dry_run": True, **preview(rule, conditions, reprice_data["preview_limit"])}
+
+        try:
+            updated, chunks, store_ids = reprice(rule, conditions, reprice_data["chunk_size"])
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(500, message="An error occurred while repricing the items, chunks already committed keep their new prices.")
+
+        # Bulk UPDATEs bypass the session events, so refresh the cached copies here
+        for store_id in store_ids:
+            current_app.coalescer.invalidate(*store_keys(store_id))
+        if current_app.catalog is not None:
+            current_app.catalog.schedule_rebuild()
+
+        return {"dry_run": False, "updated": updated, "chunks": chunks}
@@ -0,0 +1,57 @@
+import tracemalloc
+
+from flask import current_app
+from flask.views import MethodView
+from flask_smorest import Blueprint, abort
+from flask_jwt_extended import jwt_required
+
+from schemas import MemoryTraceSchema, MemoryDiffArgsSchema
+from resources.admin import require_admin
+
+blp = Blueprint("memory", __name__, description="Memory accounting of the workers (admin only)")
+
+
+# Gauges and per route stats of the worker that answers the request
+@blp.route("/memory")
+class Memory(MethodView):
+    @jwt_required()
+    def get(self):
+        require_admin()
+        return current_app.memory.summary()
+
+
+# Latest gauges published by every worker
+@blp.route("/memory/workers")
+class MemoryWorkers(MethodView):
+    @jwt_required()
+    def get(self):
+        require_admin()
+        return {"workers": current_app.memory.workers()}
+
+
+# tracemalloc snapshot diffs, for the worker that answers the request
+# (start, diff and stop land on the same worker with a single worker or sticky sessions, see memory.py)
+@blp.route("/memory/tracemalloc")
+class MemoryTrace(MethodView):
+    # Allocations since the baseline, biggest growth first
+    @jwt_required()
+    @blp.arguments(MemoryDiffArgsSchema, location="query")
+    def get(self, query_args):
+        require_admin()
+        if current_app.memory.baseline is None or not tracemalloc.is_tracing():
+            abort(404, message="tracemalloc is not running in this worker, start it with POST /memory/tracemalloc.")
+        return current_app.memory.diff(**query_args)
+
+    # Start tracing (tracemalloc slows allocations down noticeably) and take the baseline snapshot
+    @jwt_required()
+    @blp.arguments(MemoryTraceSchema)
+    def post(self, trace_data):
+        require_admin()
+        current_app.memory.start_tracing(trace_data["frames"])
+        return {"message": "Tracing started, baseline snapshot taken.", "worker": current_app.memory.worker}, 201
+
+    @jwt_required()
+    def delete(self):
+        require_admin()
+        current_app.memory.stop_tracing()
+        return {"message": "Tracing stopped."}
@@ -0,0 +1,26 @@
+from flask import current_app
+from flask.views import MethodView
+from flask_smorest import Blueprint
+from flask_jwt_extended import jwt_required
+
+from resources.admin import require_admin
+
+blp = Blueprint("metrics", __name__, description="Operational metrics (admin only)")
+
+# Counters from the single-flight layer in coalesce.py
+# coalesced: requests that waited on another request in this worker
+# remote_coalesced: requests that picked up a result computed by another worker
+@blp.route("/metrics/coalescing")
+class CoalescingMetrics(MethodView):
+    @jwt_required()
+    def get(self):
+        require_admin()
+        return current_app.coalescer.stats()
+
+# Queue depth, wait time, run time and failure rate per RQ queue (see jobs.py)
+@blp.route("/metrics/jobs")
+class JobMetrics(MethodView):
+    @jwt_required()
+    def get(self):
+        require_admin()
+        return current_app.jobs.stats()
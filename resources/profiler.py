@@ -0,0 +1,69 @@
+from flask import current_app
+from flask.views import MethodView
+from flask_smorest import Blueprint, abort
+from flask_jwt_extended import jwt_required
+
+from schemas import ProfilerStartSchema
+from resources.admin import require_admin
+
+blp = Blueprint("profiler", __name__, description="On-demand profiling of this worker (admin only)")
+
+
+# Get the current (or last) profiling session or return a 404 error
+def get_session_or_404():
+    session = current_app.profiler.session
+    if session is None:
+        abort(404, message="No profiling session has been started.")
+    return session
+
+
+@blp.route("/profiler")
+class Profiler(MethodView):
+    # Status of the current or last session
+    @jwt_required()
+    def get(self):
+        require_admin()
+        return get_session_or_404().summary()
+
+    # Start profiling for a time window and/or the next N requests matching a route
+    @jwt_required()
+    @blp.arguments(ProfilerStartSchema)
+    def post(self, profiler_data):
+        require_admin()
+        if "seconds" not in profiler_data and "requests" not in profiler_data:
+            abort(400, message="Provide seconds and/or requests to limit the profiling session.")
+
+        session = current_app.profiler.start(
+            seconds=profiler_data.get("seconds"),
+            requests=profiler_data.get("requests"),
+            route=profiler_data.get("route"),
+            interval=profiler_data["interval_ms"] / 1000,
+        )
+        if session is None:
+            abort(409, message="A profiling session is already running.")
+        return session.summary(), 201
+
+    # Stop the running session early, results stay available
+    @jwt_required()
+    def delete(self):
+        require_admin()
+        get_session_or_404()
+        return current_app.profiler.stop().summary()
+
+
+# Collapsed stacks, can be fed straight to flamegraph.pl or loaded in speedscope
+@blp.route("/profiler/flamegraph")
+class ProfilerFlamegraph(MethodView):
+    @jwt_required()
+    def get(self):
+        require_admin()
+        return get_session_or_404().collapsed(), 200, {"Content-Type": "text/plain"}
+
+
+# cProfile stats of the profiled requests, sorted by cumulative time
+@blp.route("/profiler/cprofile")
+class ProfilerCProfile(MethodView):
+    @jwt_required()
+    def get(self):
+        require_admin()
+        return get_session_or_404().cprofile_report(), 200, {"Content-Type": "text/plain"}
@@ -1,3 +1,4 @@
+from flask import current_app, jsonify
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
@@ -7,7 +8,10 @@ from db import db
 from models import StoreModel
 
 # Import Schema
-from schemas import StoreSchema
+from schemas import StoreSchema, MultiGetArgsSchema
+
+from coalesce import store_keys
+import reads
 
 blp = Blueprint("stores", __name__, description = "Operations on stores")
 
@@ -15,8 +19,17 @@ blp = Blueprint("stores", __name__, description = "Operations on stores")
 class Store(MethodView):
     @blp.response(200,StoreSchema)
     def get(self, store_id):
-        store = StoreModel.query.get_or_404(store_id)
-        return store
+        # Serve from the shared catalog snapshot when it is enabled (see snapshot.py)
+        if current_app.catalog is not None:
+            return jsonify(current_app.catalog.store_or_404(store_id))
+
+        # Identical concurrent requests for a store share one query and serialization (see coalesce.py)
+        # The result is already dumped, so it is returned as a response to skip dumping it again
+        store = current_app.coalescer.do(
+            store_keys(store_id)[0],
+            lambda: StoreSchema().dump(StoreModel.query.get_or_404(store_id)),
+        )
+        return jsonify(store)
 
     def delete(self, store_id):
         # Flask SQLAlchemy allows us to perform a get query on our StoreModel
@@ -27,15 +40,23 @@ class Store(MethodView):
         db.session.delete(store)
         # Write to database (save to disk)
         db.session.commit()
+        current_app.coalescer.invalidate(*store_keys(store_id))
+        current_app.tag_bitmaps.invalidate(store_id)
 
         # We then return a message to the client, due to the query we will also get a 202 success message
         return {"message": "Store deleted."}
 
 @blp.route("/store")
 class StoreList(MethodView):
+    # Optional ?ids=1,2,3 query string to fetch only those stores with a single IN query
+    @blp.arguments(MultiGetArgsSchema, location="query")
     @blp.response(200, StoreSchema(many=True))
-    def get(self):
-        return StoreModel.query.all()
+    def get(self, query_args):
+        if current_app.catalog is not None:
+            return jsonify(current_app.catalog.stores(query_args.get("ids")))
+
+        # Plain rows assembled into records instead of ORM instances (see reads.py)
+        return reads.stores(query_args.get("ids"))
 
     @blp.arguments(StoreSchema)
     @blp.response(201, StoreSchema)
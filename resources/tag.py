@@ -1,6 +1,8 @@
+from flask import current_app, jsonify
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload
 
 # Import database
 from db import db
@@ -9,6 +11,12 @@ from models import TagModel, StoreModel, ItemModel
 # Import Schema
 from schemas import TagSchema
 from schemas import TagAndItemSchema
+from schemas import MultiGetArgsSchema
+from schemas import TagFilterArgsSchema
+from schemas import ItemSchema
+
+from coalesce import store_keys
+import reads
 
 blp = Blueprint("tags", __name__, description = "Operations on tags")
 
@@ -20,9 +28,19 @@ class TagsInStore(MethodView):
     @blp.response(200, TagSchema(many=True))
     # Request is providing a store_id to show all associated tags which gets passed to the GET request
     def get(self, store_id):
-        store = StoreModel.query.get_or_404(store_id)
-        # Return the StoreModel showing all tags
-        return store.tags.all()
+        # Serve from the shared catalog snapshot when it is enabled (see snapshot.py)
+        if current_app.catalog is not None:
+            return jsonify(current_app.catalog.store_tags_or_404(store_id))
+
+        # Identical concurrent requests for a store's tags share one query and serialization (see coalesce.py)
+        def load_tags():
+            # Plain rows assembled into records instead of ORM instances (see reads.py)
+            tags = reads.store_tags(store_id)
+            if tags is None:
+                abort(404)
+            return TagSchema(many=True).dump(tags)
+
+        return jsonify(current_app.coalescer.do(store_keys(store_id)[1], load_tags))
 
     # We enforce schema for the incoming argument request (json payload)
     @blp.arguments(TagSchema)
@@ -45,9 +63,28 @@ class TagsInStore(MethodView):
                 500,
                 message=str(e), #Return the exception provided by SQLAlchemyError
             )
+        current_app.coalescer.invalidate(*store_keys(store_id))
+        current_app.tag_bitmaps.invalidate(store_id)
 
         return tag
 
+# Filter a store's items by tags, e.g. /store/1/items?tags=organic,sale&exclude=discontinued
+# Items must have every tag in tags and none in exclude, matched on the per-tag bitmaps (see tagbitmaps.py)
+@blp.route("/store/<int:store_id>/items")
+class ItemsInStoreByTag(MethodView):
+    @blp.arguments(TagFilterArgsSchema, location="query")
+    @blp.response(200, ItemSchema(many=True))
+    def get(self, query_args, store_id):
+        StoreModel.query.get_or_404(store_id)
+        item_ids = current_app.tag_bitmaps.filter(store_id, query_args["tags"], query_args["exclude"])
+        if not item_ids:
+            return []
+
+        # One IN query for the matching items, plus one query each for their stores and tags
+        return ItemModel.query.options(
+            selectinload(ItemModel.store), selectinload(ItemModel.tags)
+        ).filter(ItemModel.id.in_(item_ids)).order_by(ItemModel.id).all()
+
 # Decorator to determine the route in which methodviews will call to
 @blp.route("/item/<int:item_id>/tag/<int:tag_id>")
 class LinkTagsToItem(MethodView):
@@ -72,6 +109,9 @@ class LinkTagsToItem(MethodView):
             db.session.commit()
         except SQLAlchemyError:
             abort(500, message="An error occurred while inserting the tag.")
+        current_app.coalescer.invalidate(*store_keys(item.store_id))
+        # Set the item's bit in the tag's bitmap
+        current_app.tag_bitmaps.link(item.store_id, tag.id, item.id)
 
         # Return information about the new tag created
         return tag
@@ -97,6 +137,9 @@ class LinkTagsToItem(MethodView):
             db.session.commit()
         except SQLAlchemyError:
             abort(500, message="An error occurred while inserting the tag.")
+        current_app.coalescer.invalidate(*store_keys(item.store_id))
+        # Clear the item's bit in the tag's bitmap
+        current_app.tag_bitmaps.unlink(item.store_id, tag.id, item.id)
 
         # Let client know the tag was succesfully removed
         return {"message": "Item removed from tag", "item": item, "tag": tag}
@@ -107,6 +150,10 @@ class Tag(MethodView):
     # Request to get information about an individual tag (store it is associated with)
     @blp.response(200, TagSchema)
     def get(self, tag_id):
+        # Serve from the shared catalog snapshot when it is enabled (see snapshot.py)
+        if current_app.catalog is not None:
+            return jsonify(current_app.catalog.tag_or_404(tag_id))
+
         tag = TagModel.query.get_or_404(tag_id)
         return tag
 
@@ -134,8 +181,27 @@ class Tag(MethodView):
             # Delete the tag and remove from database
             db.session.delete(tag)
             db.session.commit()
+            current_app.coalescer.invalidate(*store_keys(tag.store_id))
+            current_app.tag_bitmaps.invalidate(tag.store_id)
             return {"message": "Tag deleted."}
         abort(
             400,
             message="Could not delete tag. Make sure tag is not associated with any items, then try again.",
-        )
\ No newline at end of file
+        )
+
+# Multi-get for tags so clients don't need one GET /tags/<id> per tag
+@blp.route("/tags")
+class TagList(MethodView):
+    # Query string is required here (e.g. /tags?ids=1,2,3)
+    @blp.arguments(MultiGetArgsSchema, location="query")
+    @blp.response(200, TagSchema(many=True))
+    def get(self, query_args):
+        if "ids" not in query_args:
+            abort(400, message="Provide the tags to fetch with ?ids=1,2,3.")
+        if current_app.catalog is not None:
+            return jsonify(current_app.catalog.tags(query_args["ids"]))
+
+        # One IN query for the tags, plus one query each for their stores and items
+        return TagModel.query.options(
+            selectinload(TagModel.store), selectinload(TagModel.items)
+        ).filter(TagModel.id.in_(query_args["ids"])).all()
@@ -1,6 +1,7 @@
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
 from passlib.hash import pbkdf2_sha256
+from redis.exceptions import RedisError
 from sqlalchemy.exc import SQLAlchemyError
 from flask_jwt_extended import create_access_token, get_jwt, jwt_required, create_refresh_token, get_jwt_identity
 from sqlalchemy import or_
@@ -94,13 +95,18 @@ class UserRegister(MethodView):
             db.session.add(user)
             # Write to database (save to disk)
             db.session.commit()
-            # Send message upon registration
-            current_app.queue.enqueue(send_user_registration_email, user.email, user.username)
 
         # Unless there is a generic error with inserting into the database
         except SQLAlchemyError:
             abort(500, message="An error occurred while inserting the item.")
 
+        # Send message upon registration
+        # The user is already saved, so a queue that is down must not turn the registration into an error
+        try:
+            current_app.jobs.enqueue(send_user_registration_email, user.email, user.username, queue="emails")
+        except (RedisError, RuntimeError):
+            current_app.logger.exception(f"Could not queue the registration email for user {user.id}.")
+
         # Return a message to the client
         return {"message": "User created successfully."}, 201
 
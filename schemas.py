@@ -1,4 +1,9 @@
-from marshmallow import Schema, fields
+import re
+
+from marshmallow import Schema, ValidationError, fields, validate
+from webargs.fields import DelimitedList
+
+from profiler import MAX_SESSION_SECONDS
 
 # Create Schema for validating incoming data and turning outgoing data into valid datasets
 # Validation will be handled by marshmallow
@@ -41,6 +46,75 @@ class TagSchema(PlainTagSchema):
     store = fields.Nested(PlainStoreSchema(), dump_only=True)
     items = fields.List(fields.Nested(PlainItemSchema()), dump_only=True)
 
+# Largest number of ids in a multi-get and of sub-requests in a batch, so one request can't ask for the whole catalog
+MAX_MULTI_GET_IDS = 100
+MAX_BATCH_REQUESTS = 100
+
+# Query string for fetching several resources in one request (e.g. /item?ids=1,2,3)
+class MultiGetArgsSchema(Schema):
+    ids = DelimitedList(fields.Int(), validate=validate.Length(max=MAX_MULTI_GET_IDS))
+
+# Query string for filtering a store's items by tag name (e.g. /store/1/items?tags=organic,sale&exclude=discontinued)
+class TagFilterArgsSchema(Schema):
+    tags = DelimitedList(fields.Str(), load_default=list)
+    exclude = DelimitedList(fields.Str(), load_default=list)
+
+# Schemas for the /batch endpoint, each sub-request is a GET path such as /item/1
+class BatchSubRequestSchema(Schema):
+    method = fields.Str(load_default="GET")
+    path = fields.Str(required=True)
+
+class BatchRequestSchema(Schema):
+    requests = fields.List(fields.Nested(BatchSubRequestSchema()), required=True, validate=validate.Length(max=MAX_BATCH_REQUESTS))
+
+class BatchSubResponseSchema(Schema):
+    path = fields.Str()
+    status = fields.Int()
+    body = fields.Raw()
+
+class BatchResponseSchema(Schema):
+    responses = fields.List(fields.Nested(BatchSubResponseSchema()))
+
+# Pricing rule and item filter for POST /item/reprice (see pricing.py)
+class RepriceSchema(Schema):
+    # Which items, at least one filter is required
+    store_id = fields.Int()
+    tag_id = fields.Int()
+    min_id = fields.Int()
+    max_id = fields.Int()
+    # The rule: percent (-10 is 10% off) and/or amount, then rounded to round_to, never below min_price
+    percent = fields.Float(load_default=0)
+    amount = fields.Float(load_default=0)
+    round_to = fields.Float(load_default=0.01, validate=validate.Range(min=0, min_inclusive=False))
+    min_price = fields.Float(load_default=0)
+    # Preview the new prices without writing them
+    dry_run = fields.Bool(load_default=False)
+    chunk_size = fields.Int(load_default=1000, validate=validate.Range(min=1))
+    preview_limit = fields.Int(load_default=20, validate=validate.Range(min=0, max=1000))
+
+# Options for starting a profiling session, give seconds and/or requests
+# The route filter is compiled by the profiler, a bad pattern must fail here with a 422 instead
+def validate_regex(value):
+    try:
+        re.compile(value)
+    except re.error as e:
+        raise ValidationError(f"Invalid regular expression: {e}")
+
+class ProfilerStartSchema(Schema):
+    seconds = fields.Float(validate=validate.Range(min=0, min_inclusive=False, max=MAX_SESSION_SECONDS)) # length of the time window
+    requests = fields.Int(validate=validate.Range(min=1)) # stop after this many matching requests
+    route = fields.Str(validate=validate_regex) # regex matched against the request path, e.g. ^/store/
+    interval_ms = fields.Float(load_default=5, validate=validate.Range(min=1)) # how often stacks are sampled
+
+# Options for tracemalloc in resources/memory.py
+class MemoryTraceSchema(Schema):
+    frames = fields.Int(load_default=1, validate=validate.Range(min=1, max=50)) # stack frames kept per allocation
+
+class MemoryDiffArgsSchema(Schema):
+    limit = fields.Int(load_default=20, validate=validate.Range(min=1, max=500))
+    group_by = fields.Str(load_default="lineno", validate=validate.OneOf(["lineno", "filename", "traceback"]))
+    rebase = fields.Bool(load_default=False) # make this snapshot the baseline for the next diff
+
 class TagAndItemSchema(Schema):
     message = fields.Str()
     item = fields.Nested(ItemSchema)
@@ -4,4 +4,15 @@ from dotenv import load_dotenv
 load_dotenv()
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-QUEUES = ["emails", "default"]
\ No newline at end of file
+# Highest priority first: a worker always takes a job from an earlier queue before a later one
+QUEUES = ["emails", "default"]
+
+# Worker processes started for each queue by "flask jobs worker" (see jobs.py)
+# A queue's workers also pick up jobs from the queues after it when their own queue is empty
+# Override with WORKER_CONCURRENCY, e.g. WORKER_CONCURRENCY=emails:1,default:4
+QUEUE_CONCURRENCY = {"emails": 1, "default": 2}
+if os.getenv("WORKER_CONCURRENCY"):
+    QUEUE_CONCURRENCY = {
+        name: int(count)
+        for name, count in (entry.split(":") for entry in os.getenv("WORKER_CONCURRENCY").split(","))
+    }
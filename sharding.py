@@ -0,0 +1,347 @@
+"""
+sharding.py
+
+Optional horizontal sharding of store data. Each store, with its items, tags and items_tags rows,
+lives on one of N databases. Users stay on the main database (shard 0).
+
+Enable it with SHARD_DATABASE_URLS, a comma separated list of the extra databases; the main
+database (DATABASE_URL) is shard 0, the listed ones are shards 1..N-1.
+
+Placement rules:
+- a store lives on SHARD_MAP[store_id] if it is pinned there (SHARD_MAP="7:1,12:2"), otherwise on
+  store_id % N
+- items and tags live on their store's shard, and get ids with id % N == shard, so any item or
+  tag id tells which shard it is on without asking the others
+- items_tags rows live on the shard of their item (item and tag are always in the same store)
+
+Ids are handed out by counters in redis (INCR is atomic, so concurrent inserts in any worker never
+pick the same id): one for stores, and one per shard for items and for tags, whose n-th id on shard s
+is n * N + s. A counter is seeded from the highest id in the database the first time it is used.
+After inserting rows with explicit ids outside the app, run "flask shards reset-ids" so the
+counters are seeded again.
+
+Store and tag names are unique across the catalog, but each shard's unique index only sees its own
+rows. A new (or renamed) store or tag first claims its name in redis (SET NX, so two transactions
+never both pass), then checks every shard for a row that already has it. A name that is taken fails
+the flush with an IntegrityError, like the unique index does without sharding. Claims are released
+when the transaction ends, from then on the committed row is what the check finds.
+
+db.session is replaced with a SQLAlchemy ShardedSession, so the queries in resources/ do not need
+to change: primary key lookups (get_or_404) go to one shard, queries that filter on a store id
+or on item/tag ids go to the matching shards, lazy loads stay on the parent's shard, and anything
+else (e.g. ItemModel.query.all() for the list endpoints) fans out to every shard and the results
+are merged.
+
+Each shard needs the schema: run "flask db upgrade" once per shard with DATABASE_URL pointing at
+it, or "flask shards create-all" for local sqlite files. The ASGI read path (asgi.py) and the
+online migration helpers only use the main database, so create_asgi_app and "flask online seed"
+refuse to run when sharding is enabled; serve with SERVER_MODE=wsgi.
+"""
+
+import uuid
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from redis.exceptions import RedisError
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.sql import operators, visitors
+from flask_sqlalchemy.session import Session as FlaskSession
+
+from db import db
+from models import StoreModel, ItemModel, TagModel, ItemsTags
+
+SHARDED_MODELS = (StoreModel, ItemModel, TagModel, ItemsTags)
+MAIN_SHARD = "0"
+
+
+# A SQLAlchemyError, so the resources handle it like any other failed write
+class ShardingError(SQLAlchemyError):
+    pass
+
+
+# A store or tag name already used on one of the shards
+class DuplicateNameError(IntegrityError):
+    def __init__(self, message):
+        super().__init__(None, None, ShardingError(message))
+
+
+# Deletes a name claim only if it still belongs to the transaction that took it
+RELEASE_CLAIM = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# Increments the counter, or returns nil when it does not exist yet so the caller can seed it first
+INCR_IF_EXISTS = """
+if redis.call("exists", KEYS[1]) == 0 then
+    return false
+end
+return redis.call("incr", KEYS[1])
+"""
+
+
+class ShardRouter:
+    def __init__(self, shard_count, shard_map=None):
+        self.shard_count = shard_count
+        # Stores pinned to a shard, e.g. a large tenant moved to its own database
+        self.shard_map = shard_map or {}
+
+    @property
+    def shard_ids(self):
+        return [str(shard) for shard in range(self.shard_count)]
+
+    def store_shard(self, store_id):
+        return str(self.shard_map.get(store_id, store_id % self.shard_count))
+
+    # Items and tags get ids on their shard's residue, see id_for_sequence
+    def id_shard(self, resource_id):
+        return str(resource_id % self.shard_count)
+
+    # The n-th item or tag id on a shard
+    def id_for_sequence(self, sequence, shard):
+        return sequence * self.shard_count + int(shard)
+
+    # Last sequence number used on a shard whose highest id is max_id (-1 for an empty shard > 0)
+    def sequence_for_id(self, max_id, shard):
+        return ((max_id or 0) - int(shard)) // self.shard_count
+
+    # Shard for an object being written
+    def shard_for_instance(self, mapper, instance, **kw):
+        model = mapper.class_ if mapper is not None else None
+        if instance is None or model not in SHARDED_MODELS:
+            return MAIN_SHARD
+        if model is StoreModel:
+            return self.store_shard(instance.id)
+        if model is ItemsTags:
+            return self.id_shard(instance.item_id)
+        return self.id_shard(instance.id)
+
+    # Shards that can hold a primary key
+    def shards_for_identity(self, mapper, primary_key, **kw):
+        model = mapper.class_
+        if model is StoreModel:
+            return [self.store_shard(primary_key[0])]
+        if model in (ItemModel, TagModel):
+            return [self.id_shard(primary_key[0])]
+        if model is ItemsTags:
+            return self.shard_ids
+        return [MAIN_SHARD]
+
+    # Shards a query has to run on: narrowed by store_id / id comparisons when it has them, otherwise all
+    def shards_for_query(self, orm_context):
+        mapper = orm_context.bind_mapper
+        if mapper is None or mapper.class_ not in SHARDED_MODELS:
+            return [MAIN_SHARD]
+
+        shards = set()
+        for column, values in self._compared_values(orm_context.statement):
+            table = column.table.name if hasattr(column, "table") else None
+            if (table == "stores" and column.name == "id") or (table in ("items", "tags") and column.name == "store_id"):
+                shards.update(self.store_shard(value) for value in values)
+            elif table in ("items", "tags") and column.name == "id":
+                shards.update(self.id_shard(value) for value in values)
+            elif table == "items_tags" and column.name == "item_id":
+                shards.update(self.id_shard(value) for value in values)
+        return sorted(shards) or self.shard_ids
+
+    # (column, values) for each "column = value" and "column IN (values)" in the statement's criteria
+    def _compared_values(self, statement):
+        found = []
+
+        def visit_binary(binary):
+            if binary.operator not in (operators.eq, operators.in_op):
+                return
+            column, parameter = binary.left, binary.right
+            if not hasattr(column, "name") or not hasattr(parameter, "effective_value"):
+                return
+            value = parameter.effective_value
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            if all(isinstance(item, int) for item in values):
+                found.append((column, values))
+
+        visitors.traverse(statement, {}, {"binary": visit_binary})
+        return found
+
+
+class IdAllocator:
+    def __init__(self, redis_connection, router, namespace="shards:ids"):
+        self.redis = redis_connection
+        self.router = router
+        self.namespace = namespace
+        self._incr = redis_connection.register_script(INCR_IF_EXISTS)
+
+    # Stores take the next id across all shards, their shard follows from it
+    def store_id(self, session):
+        return self._next(f"{self.namespace}:stores", lambda: session.max_id(StoreModel, self.router.shard_ids))
+
+    def shard_id(self, session, model, shard):
+        sequence = self._next(
+            f"{self.namespace}:{model.__tablename__}:{shard}",
+            lambda: self.router.sequence_for_id(session.max_id(model, [shard]), shard),
+        )
+        return self.router.id_for_sequence(sequence, shard)
+
+    # current() is only called (max() queries on the shards) when the counter has to be seeded
+    def _next(self, key, current):
+        try:
+            value = self._incr(keys=[key])
+            if value is None:
+                # Whoever seeds first wins, the others increment what it set
+                self.redis.set(key, current(), nx=True)
+                value = self._incr(keys=[key])
+        except RedisError as e:
+            raise ShardingError(f"Could not allocate an id: {e}") from e
+        return int(value)
+
+    # Drop the counters, they are seeded from the databases again on the next insert
+    def reset(self):
+        keys = list(self.redis.scan_iter(f"{self.namespace}:*"))
+        if keys:
+            self.redis.delete(*keys)
+        return len(keys)
+
+
+class UniqueNames:
+    # Claims outlive a transaction only if its worker died before releasing them
+    CLAIM_SECONDS = 60
+
+    def __init__(self, redis_connection, namespace="shards:names"):
+        self.redis = redis_connection
+        self.namespace = namespace
+        self._release = redis_connection.register_script(RELEASE_CLAIM)
+
+    # Fails the flush when another transaction is adding the name, or a row on any shard has it
+    def claim(self, session, instance):
+        model = type(instance)
+        key = f"{self.namespace}:{model.__tablename__}:{instance.name}"
+        token = uuid.uuid4().hex
+        try:
+            claimed = self.redis.set(key, token, nx=True, ex=self.CLAIM_SECONDS)
+        except RedisError as e:
+            raise ShardingError(f"Could not check that the name is unique: {e}") from e
+        if not claimed:
+            raise DuplicateNameError(f"{model.__tablename__}.name {instance.name!r} is already used.")
+        session.info.setdefault("name_claims", []).append((key, token))
+
+        # No where clause the router can narrow, so this runs on every shard
+        taken = session.execute(select(model.id).where(model.name == instance.name, model.id != instance.id)).first()
+        if taken is not None:
+            raise DuplicateNameError(f"{model.__tablename__}.name {instance.name!r} is already used.")
+
+    # Called when the transaction commits or rolls back
+    def release(self, session):
+        for key, token in session.info.pop("name_claims", []):
+            try:
+                self._release(keys=[key], args=[token])
+            except RedisError:
+                # It expires on its own after CLAIM_SECONDS
+                pass
+
+
+class ShardedFlaskSession(ShardedSession, FlaskSession):
+    def __init__(self, db, router, allocator, names, **kwargs):
+        self.router = router
+        self.allocator = allocator
+        self.names = names
+        engines = db.engines
+        # ShardedSession passes db on to the flask-sqlalchemy Session through super().__init__
+        ShardedSession.__init__(
+            self,
+            shard_chooser=router.shard_for_instance,
+            identity_chooser=router.shards_for_identity,
+            execute_chooser=router.shards_for_query,
+            shards={shard: engines[None if shard == MAIN_SHARD else f"shard{shard}"] for shard in router.shard_ids},
+            db=db,
+            **kwargs,
+        )
+        self.info["flush_shard"] = MAIN_SHARD
+
+    def get_bind(self, mapper=None, *, shard_id=None, instance=None, clause=None, **kw):
+        # Writes that carry no instance (the items_tags rows behind item.tags) go to the shard being flushed
+        if shard_id is None and instance is None:
+            shard_id = self.info["flush_shard"]
+        return ShardedSession.get_bind(self, mapper, shard_id=shard_id, instance=instance, clause=clause, **kw)
+
+    # Give new rows their shard placement and ids before they are written
+    def flush(self, objects=None):
+        with self.no_autoflush:
+            self._assign_shards()
+        super().flush(objects)
+
+    def _assign_shards(self):
+        shards = set()
+        for instance in self.new:
+            if isinstance(instance, StoreModel) and instance.id is None:
+                instance.id = self.allocator.store_id(self)
+            elif isinstance(instance, (ItemModel, TagModel)):
+                shard = self.router.store_shard(instance.store_id)
+                if instance.id is None:
+                    instance.id = self.allocator.shard_id(self, type(instance), shard)
+                elif self.router.id_shard(instance.id) != shard:
+                    raise ShardingError(f"Id {instance.id} does not belong to the shard of store {instance.store_id}.")
+
+        for instance in list(self.new) + list(self.dirty):
+            if isinstance(instance, (StoreModel, TagModel)) and (instance in self.new or inspect(instance).attrs.name.history.has_changes()):
+                self.names.claim(self, instance)
+
+        for instance in list(self.new) + list(self.dirty) + list(self.deleted):
+            if isinstance(instance, SHARDED_MODELS):
+                shards.add(self.router.shard_for_instance(type(instance).__mapper__, instance))
+        if len(shards) > 1:
+            raise ShardingError("A single flush can only write to one shard.")
+        self.info["flush_shard"] = shards.pop() if shards else MAIN_SHARD
+
+    def max_id(self, model, shards):
+        return max(
+            (self.execute(select(func.max(model.id)), bind_arguments={"shard_id": shard}).scalar() or 0)
+            for shard in shards
+        )
+
+
+# Name claims are only needed until the transaction ends: committed, rolled back, or
+# closed after a failed flush (which doesn't emit after_rollback)
+@event.listens_for(ShardedFlaskSession, "after_transaction_end")
+def _release_name_claims(session, transaction):
+    if transaction.parent is None:
+        session.names.release(session)
+
+
+def parse_shard_map(value):
+    shard_map = {}
+    for entry in filter(None, (value or "").split(",")):
+        store_id, shard = entry.split(":")
+        shard_map[int(store_id)] = int(shard)
+    return shard_map
+
+
+# Called from create_app before db.init_app, when SHARD_DATABASE_URLS is set
+def init_sharding(app, shard_urls, redis_connection, shard_map=None):
+    router = ShardRouter(len(shard_urls) + 1, parse_shard_map(shard_map))
+    app.config["SQLALCHEMY_BINDS"] = {f"shard{index}": url for index, url in enumerate(shard_urls, start=1)}
+    app.id_allocator = IdAllocator(redis_connection, router)
+    names = UniqueNames(redis_connection)
+    db.session = db._make_scoped_session({"class_": ShardedFlaskSession, "router": router, "allocator": app.id_allocator, "names": names})
+    app.cli.add_command(shards_cli)
+    return router
+
+
+shards_cli = AppGroup("shards", help="Manage the store shards.")
+
+
+@shards_cli.command("create-all")
+def create_all_command():
+    """Create the tables on every shard (for local sqlite shards, use migrations in production)."""
+    for key, engine in db.engines.items():
+        db.metadata.create_all(engine)
+        click.echo(f"Created tables on {key or 'main'} ({engine.url}).")
+
+
+@shards_cli.command("reset-ids")
+def reset_ids_command():
+    """Reseed the id counters from the databases, after inserting rows with explicit ids."""
+    click.echo(f"Reset {current_app.id_allocator.reset()} id counters.")
@@ -0,0 +1,342 @@
+"""
+snapshot.py
+
+Optional read-only snapshot of the catalog (stores, items, tags and their links), shared by
+all gunicorn workers through a memory-mapped file. Enable it by setting CATALOG_SNAPSHOT to
+a file path. The GET store/item/tag endpoints are then answered from the mapping without
+touching the database, and since the pages of the file are shared by the OS, the memory used
+does not grow with the number of workers.
+
+File layout: an 8 byte magic, a 4 byte header length, a JSON header listing the sections, then
+the sections themselves. Each section is a flat array (ids, foreign keys, prices, offsets into
+one utf-8 string blob), sorted so lookups are binary searches:
+- stores, items and tags sorted by id
+- store_items / store_tags: (store_id, row) pairs sorted by store_id, then id
+- item_tags / tag_items: (item_id, tag row) and (tag_id, item row) pairs from items_tags
+
+The snapshot is rebuilt in the background shortly after a commit that changed a store, item,
+tag or link, and every CATALOG_SNAPSHOT_INTERVAL seconds if set. Each commit pushes the rebuild
+back by rebuild_delay so a burst of writes leads to one rebuild, but never further than max_delay
+after the first commit it is waiting for, so reads lag behind a write by at most max_delay
+(plus the time the rebuild takes) even while writes keep coming. A new file is written next to the old one and swapped in with
+os.replace, workers notice the new file on their next read and map it.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right
+
+from flask_smorest import abort
+from sqlalchemy import event, select
+
+from db import db
+from models import StoreModel, ItemModel, TagModel, ItemsTags
+
+MAGIC = b"CATSNAP1"
+CATALOG_MODELS = (StoreModel, ItemModel, TagModel, ItemsTags)
+
+
+# Write the catalog from the database into a new snapshot file at path
+def build_snapshot(path):
+    # Sorted here as well as in the query, with sharding (see sharding.py) the rows come from several databases
+    def by_id(rows):
+        return sorted(rows, key=lambda row: row.id)
+
+    stores = by_id(db.session.execute(select(StoreModel.id, StoreModel.name).order_by(StoreModel.id)))
+    items = by_id(db.session.execute(
+        select(ItemModel.id, ItemModel.store_id, ItemModel.name, ItemModel.price).order_by(ItemModel.id)
+    ))
+    tags = by_id(db.session.execute(select(TagModel.id, TagModel.store_id, TagModel.name).order_by(TagModel.id)))
+    links = db.session.execute(select(ItemsTags.item_id, ItemsTags.tag_id)).all()
+
+    strings = bytearray()
+
+    def add_string(value):
+        encoded = (value or "").encode()
+        offset = len(strings)
+        strings.extend(encoded)
+        return offset, len(encoded)
+
+    sections = {}
+
+    def add_rows(prefix, rows, columns):
+        # columns: (name, typecode, getter), strings are stored as an offset and a length
+        for name, typecode, getter in columns:
+            if typecode == "s":
+                refs = [add_string(getter(row)) for row in rows]
+                sections[f"{prefix}_{name}_off"] = array("q", (ref[0] for ref in refs))
+                sections[f"{prefix}_{name}_len"] = array("q", (ref[1] for ref in refs))
+            else:
+                sections[f"{prefix}_{name}"] = array(typecode, (getter(row) for row in rows))
+
+    add_rows("store", stores, [("id", "q", lambda r: r.id), ("name", "s", lambda r: r.name)])
+    add_rows("item", items, [
+        ("id", "q", lambda r: r.id),
+        ("store", "q", lambda r: r.store_id),
+        ("name", "s", lambda r: r.name),
+        ("price", "d", lambda r: r.price),
+    ])
+    add_rows("tag", tags, [
+        ("id", "q", lambda r: r.id),
+        ("store", "q", lambda r: r.store_id),
+        ("name", "s", lambda r: r.name),
+    ])
+
+    item_row = {row.id: index for index, row in enumerate(items)}
+    tag_row = {row.id: index for index, row in enumerate(tags)}
+
+    def add_index(name, pairs):
+        pairs = sorted(pairs)
+        sections[f"{name}_key"] = array("q", (pair[0] for pair in pairs))
+        sections[f"{name}_row"] = array("q", (pair[-1] for pair in pairs))
+
+    # Rows are already in id order, so sorting (key, id, row) keeps each group in id order too
+    add_index("store_items", ((row.store_id, row.id, index) for index, row in enumerate(items)))
+    add_index("store_tags", ((row.store_id, row.id, index) for index, row in enumerate(tags)))
+    valid_links = [link for link in links if link.item_id in item_row and link.tag_id in tag_row]
+    add_index("item_tags", ((link.item_id, link.tag_id, tag_row[link.tag_id]) for link in valid_links))
+    add_index("tag_items", ((link.tag_id, link.item_id, item_row[link.item_id]) for link in valid_links))
+    sections["strings"] = array("B", strings)
+
+    # Lay the sections out one after the other, 8 byte aligned, after the header
+    header = {"built_at": time.time(), "sections": {}}
+    offset = 0
+    for name, values in sections.items():
+        header["sections"][name] = [values.typecode, offset, len(values)]
+        offset += len(values) * values.itemsize
+        offset += -offset % 8
+    header_bytes = json.dumps(header).encode()
+    data_start = len(MAGIC) + 4 + len(header_bytes)
+    data_start += -data_start % 8
+
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+        f.write(b"\0" * (data_start - f.tell()))
+        for name, values in sections.items():
+            f.write(values.tobytes())
+            f.write(b"\0" * (-f.tell() % 8))
+    # Atomic swap, readers either see the old file or the new one
+    os.replace(tmp_path, path)
+
+
+class _MappedSnapshot:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.stat_key = self._stat_key(os.fstat(f.fileno()))
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mapping[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot.")
+        (header_length,) = struct.unpack_from("<I", self.mapping, len(MAGIC))
+        header_start = len(MAGIC) + 4
+        self.header = json.loads(self.mapping[header_start:header_start + header_length])
+        data_start = header_start + header_length
+        data_start += -data_start % 8
+
+        view = memoryview(self.mapping)
+        self.sections = {}
+        for name, (typecode, offset, count) in self.header["sections"].items():
+            start = data_start + offset
+            size = count * array(typecode).itemsize
+            self.sections[name] = view[start:start + size].cast(typecode)
+
+    @staticmethod
+    def _stat_key(stat):
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def __getattr__(self, name):
+        try:
+            return self.sections[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def string(self, prefix, row):
+        offset = self.sections[f"{prefix}_off"][row]
+        return bytes(self.strings[offset:offset + self.sections[f"{prefix}_len"][row]]).decode()
+
+    # Position of an id in a sorted id section, or None
+    @staticmethod
+    def find(ids, resource_id):
+        row = bisect_left(ids, resource_id)
+        if row < len(ids) and ids[row] == resource_id:
+            return row
+        return None
+
+    # Rows linked to a key in one of the (key, row) index sections
+    def linked_rows(self, index, key):
+        keys = self.sections[f"{index}_key"]
+        rows = self.sections[f"{index}_row"]
+        return [rows[position] for position in range(bisect_left(keys, key), bisect_right(keys, key))]
+
+    # Plain dicts in the same shape the schemas in schemas.py dump
+    def plain_store(self, row):
+        return {"id": self.store_id[row], "name": self.string("store_name", row)}
+
+    def plain_item(self, row):
+        return {"id": self.item_id[row], "name": self.string("item_name", row), "price": self.item_price[row]}
+
+    def plain_tag(self, row):
+        return {"id": self.tag_id[row], "name": self.string("tag_name", row)}
+
+    def store_of(self, store_id):
+        row = self.find(self.store_id, store_id)
+        return None if row is None else self.plain_store(row)
+
+    def store(self, row):
+        store_id = self.store_id[row]
+        return {
+            **self.plain_store(row),
+            "items": [self.plain_item(item) for item in self.linked_rows("store_items", store_id)],
+            "tags": [self.plain_tag(tag) for tag in self.linked_rows("store_tags", store_id)],
+        }
+
+    def item(self, row):
+        return {
+            **self.plain_item(row),
+            "store": self.store_of(self.item_store[row]),
+            "tags": [self.plain_tag(tag) for tag in self.linked_rows("item_tags", self.item_id[row])],
+        }
+
+    def tag(self, row):
+        return {
+            **self.plain_tag(row),
+            "store": self.store_of(self.tag_store[row]),
+            "items": [self.plain_item(item) for item in self.linked_rows("tag_items", self.tag_id[row])],
+        }
+
+
+class CatalogSnapshot:
+    def __init__(self, app, path, interval=0, rebuild_delay=0.5, max_delay=2):
+        self.app = app
+        self.path = path
+        self.interval = interval
+        self.rebuild_delay = rebuild_delay
+        self.max_delay = max_delay
+        self._mapped = None
+        self._lock = threading.Lock()
+        self._timer = None
+        # When the first commit not in the snapshot yet happened
+        self._pending_since = None
+        self._scheduler = None
+
+        # Flag sessions that flushed catalog changes, then schedule a rebuild once they commit
+        event.listen(db.session, "after_flush", self._after_flush)
+        event.listen(db.session, "after_commit", self._after_commit)
+
+    # Current mapping, remapped whenever another worker swapped in a new file
+    def snapshot(self):
+        self._start_scheduler()
+        try:
+            stat_key = _MappedSnapshot._stat_key(os.stat(self.path))
+        except FileNotFoundError:
+            self.rebuild()
+            stat_key = _MappedSnapshot._stat_key(os.stat(self.path))
+        mapped = self._mapped
+        if mapped is None or mapped.stat_key != stat_key:
+            mapped = _MappedSnapshot(self.path)
+            self._mapped = mapped
+        return mapped
+
+    def rebuild(self):
+        with self.app.app_context():
+            build_snapshot(self.path)
+
+    # Lookups used by the GET endpoints in resources/, same 404 behaviour as get_or_404
+    def store_or_404(self, store_id):
+        snapshot = self.snapshot()
+        return snapshot.store(self._row_or_404(snapshot.store_id, store_id))
+
+    def stores(self, ids=None):
+        snapshot = self.snapshot()
+        return [snapshot.store(row) for row in self._rows(snapshot.store_id, ids)]
+
+    def item_or_404(self, item_id):
+        snapshot = self.snapshot()
+        return snapshot.item(self._row_or_404(snapshot.item_id, item_id))
+
+    def items(self, ids=None):
+        snapshot = self.snapshot()
+        return [snapshot.item(row) for row in self._rows(snapshot.item_id, ids)]
+
+    def tag_or_404(self, tag_id):
+        snapshot = self.snapshot()
+        return snapshot.tag(self._row_or_404(snapshot.tag_id, tag_id))
+
+    def tags(self, ids):
+        snapshot = self.snapshot()
+        return [snapshot.tag(row) for row in self._rows(snapshot.tag_id, ids)]
+
+    def store_tags_or_404(self, store_id):
+        snapshot = self.snapshot()
+        self._row_or_404(snapshot.store_id, store_id)
+        return [snapshot.tag(row) for row in snapshot.linked_rows("store_tags", store_id)]
+
+    @staticmethod
+    def _row_or_404(ids, resource_id):
+        row = _MappedSnapshot.find(ids, resource_id)
+        if row is None:
+            abort(404)
+        return row
+
+    @staticmethod
+    def _rows(ids, wanted=None):
+        if wanted is None:
+            return range(len(ids))
+        rows = (_MappedSnapshot.find(ids, resource_id) for resource_id in sorted(set(wanted)))
+        return [row for row in rows if row is not None]
+
+    def _after_flush(self, session, flush_context):
+        changed = list(session.new) + list(session.dirty) + list(session.deleted)
+        if any(isinstance(instance, CATALOG_MODELS) for instance in changed):
+            session.info["catalog_changed"] = True
+
+    def _after_commit(self, session):
+        if session.info.pop("catalog_changed", False):
+            self.schedule_rebuild()
+
+    # Debounced: a burst of writes leads to one rebuild, due max_delay after its first write at the latest
+    def schedule_rebuild(self):
+        with self._lock:
+            now = time.time()
+            if self._pending_since is None:
+                self._pending_since = now
+            due = min(now + self.rebuild_delay, self._pending_since + self.max_delay)
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(max(0, due - now), self._debounced_rebuild)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _debounced_rebuild(self):
+        with self._lock:
+            # Commits from here on are not guaranteed to be in this rebuild, they schedule the next one
+            self._pending_since = None
+            self._timer = None
+        self.rebuild()
+
+    # Started on first use rather than in create_app, so it runs in each gunicorn worker after the fork
+    def _start_scheduler(self):
+        if not self.interval or self._scheduler is not None:
+            return
+        with self._lock:
+            if self._scheduler is None:
+                self._scheduler = threading.Thread(target=self._scheduled_rebuilds, daemon=True)
+                self._scheduler.start()
+
+    def _scheduled_rebuilds(self):
+        while True:
+            time.sleep(self.interval)
+            # Every worker runs this loop, only rebuild if no other worker did it recently
+            try:
+                age = time.time() - os.stat(self.path).st_mtime
+            except FileNotFoundError:
+                age = self.interval
+            if age >= self.interval:
+                self.rebuild()
@@ -0,0 +1,83 @@
+"""
+startup.py
+
+Startup-time report: how long each import of the app takes and how long each phase of
+create_app() takes. Used by "python boot.py report" and by gunicorn.conf.py when
+STARTUP_REPORT=1 is set.
+"""
+
+import importlib
+import sys
+import time
+
+# Modules app.py pulls in, in the order it imports them. Each one is timed on its own, so a
+# module's time only covers what earlier modules had not already imported.
+APP_IMPORTS = [
+    "flask",
+    "flask_smorest",
+    "flask_jwt_extended",
+    "flask_migrate",
+    "redis",
+    "rq",
+    "dotenv",
+    "sqlalchemy",
+    "db",
+    "models",
+    "coalesce",
+    "profiler",
+    "memory",
+    "snapshot",
+    "online_migrations",
+    "ratelimit",
+    "sharding",
+    "jobs",
+    "reads",
+    "resources.item",
+    "resources.store",
+    "resources.tag",
+    "resources.user",
+    "resources.metrics",
+    "resources.batch",
+    "resources.profiler",
+    "resources.memory",
+    "app",
+]
+
+
+# Times the phases of create_app(), each mark() records the time since the previous one
+class StartupTimer:
+    def __init__(self):
+        self.started = self._last = time.perf_counter()
+        self.phases = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self.started
+
+
+def time_imports(modules=APP_IMPORTS):
+    timings = []
+    for module in modules:
+        if module in sys.modules:
+            timings.append((module, 0.0))
+            continue
+        start = time.perf_counter()
+        importlib.import_module(module)
+        timings.append((module, time.perf_counter() - start))
+    return timings
+
+
+def format_report(import_timings, timer):
+    lines = ["Startup time report"]
+    if import_timings:
+        lines.append(f"imports: {sum(seconds for _name, seconds in import_timings) * 1000:.1f} ms")
+        lines += [f"  {seconds * 1000:8.1f} ms  {name}" for name, seconds in import_timings]
+    if timer is not None:
+        lines.append(f"create_app(): {timer.total * 1000:.1f} ms")
+        lines += [f"  {seconds * 1000:8.1f} ms  {name}" for name, seconds in timer.phases]
+    return "\n".join(lines)
@@ -0,0 +1,187 @@
+"""
+tagbitmaps.py
+
+Per-tag item bitmaps for boolean tag filters such as "items in store 7 tagged organic and
+on-sale but not discontinued" (GET /store/<id>/items?tags=organic,on-sale&exclude=discontinued).
+
+For each store we keep one bitmap per tag plus one for all of the store's items. Bitmaps are
+Python ints over positions, not ids: the store's item ids are kept in a sorted array and bit i
+stands for the i-th of them. A store's ids are spread over the whole catalog's id range (every
+store shares one id sequence, and ids step by the shard count when sharded), so bits indexed by id
+would grow with the catalog instead of with the store. AND / AND NOT on ints run in C, so a filter
+costs time in the number of the store's items, whatever the size of items_tags.
+
+Bitmaps of at most max_stores stores are kept per worker, the least recently queried are dropped.
+
+A store's bitmaps are built from items_tags the first time the store is queried, then:
+- link/unlink in resources/tag.py set or clear the bit directly
+- other writes to a store's items or tags drop the store's bitmaps, they are rebuilt on the next query
+- each write bumps a per-store version in redis, so other workers see their copy is stale and
+  rebuild it. If redis is unreachable, copies are rebuilt once they are older than max_age seconds
+
+Filtered ids come back in ascending order. Unknown tag names in tags match nothing, unknown names
+in exclude are ignored.
+"""
+
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+from sqlalchemy import select
+
+from db import db
+from models import ItemModel, TagModel, ItemsTags
+
+# After redis fails, fall back to max_age for this long before trying redis again
+REDIS_RETRY_SECONDS = 30
+
+
+class _StoreBitmaps:
+    def __init__(self, item_ids, tags, tag_ids, version):
+        # Sorted item ids of the store, bit i of a bitmap is item_ids[i]
+        self.item_ids = item_ids
+        # Bitmap of every item in the store
+        self.items = (1 << len(item_ids)) - 1
+        # tag name -> bitmap, tag id -> tag name
+        self.tags = tags
+        self.tag_ids = tag_ids
+        self.version = version
+        self.built_at = time.time()
+
+    # Bit position of an item id, None when the item was not in the store at build time
+    def position(self, item_id):
+        index = bisect_left(self.item_ids, item_id)
+        if index < len(self.item_ids) and self.item_ids[index] == item_id:
+            return index
+        return None
+
+
+class TagBitmaps:
+    def __init__(self, redis_connection=None, max_age=5, max_stores=1000):
+        self.redis = redis_connection
+        self.max_age = max_age
+        self.max_stores = max_stores
+        self._lock = threading.Lock()
+        # store id -> bitmaps, least recently queried first
+        self._stores = OrderedDict()
+        self._redis_down_until = 0
+
+    # Item ids in the store that have every tag in tags and none in exclude
+    def filter(self, store_id, tags=(), exclude=()):
+        bitmaps = self._get(store_id)
+        result = bitmaps.items
+        for name in tags:
+            # An unknown tag matches nothing
+            result &= bitmaps.tags.get(name, 0)
+        for name in exclude:
+            result &= ~bitmaps.tags.get(name, 0)
+        return self._ids(result, bitmaps.item_ids)
+
+    def link(self, store_id, tag_id, item_id):
+        self._update(store_id, tag_id, item_id, True)
+
+    def unlink(self, store_id, tag_id, item_id):
+        self._update(store_id, tag_id, item_id, False)
+
+    # Drop the store's bitmaps after a write they cannot be patched for (new items, tags, deletes)
+    def invalidate(self, store_id):
+        self._bump_version(store_id)
+        with self._lock:
+            self._stores.pop(store_id, None)
+
+    def _update(self, store_id, tag_id, item_id, linked):
+        version = self._bump_version(store_id)
+        with self._lock:
+            bitmaps = self._stores.get(store_id)
+            if bitmaps is None:
+                return
+            name = bitmaps.tag_ids.get(tag_id)
+            position = bitmaps.position(item_id)
+            stale = version is not None and version != bitmaps.version + 1
+            if name is None or position is None or stale:
+                # Something else changed in between, rebuild on the next query instead
+                del self._stores[store_id]
+                return
+            bit = 1 << position
+            bitmaps.tags[name] = bitmaps.tags[name] | bit if linked else bitmaps.tags[name] & ~bit
+            bitmaps.version = version if version is not None else bitmaps.version
+
+    def _get(self, store_id):
+        version = self._version(store_id)
+        with self._lock:
+            bitmaps = self._stores.get(store_id)
+            if bitmaps is not None:
+                self._stores.move_to_end(store_id)
+        if bitmaps is not None:
+            fresh = bitmaps.version == version if version is not None else time.time() - bitmaps.built_at < self.max_age
+            if fresh:
+                return bitmaps
+
+        bitmaps = self._build(store_id, version or 0)
+        with self._lock:
+            self._stores[store_id] = bitmaps
+            self._stores.move_to_end(store_id)
+            while len(self._stores) > self.max_stores:
+                self._stores.popitem(last=False)
+        return bitmaps
+
+    def _build(self, store_id, version):
+        item_ids = db.session.execute(select(ItemModel.id).where(ItemModel.store_id == store_id)).scalars().all()
+        tags = db.session.execute(select(TagModel.id, TagModel.name).where(TagModel.store_id == store_id)).all()
+        links = db.session.execute(
+            select(ItemsTags.tag_id, ItemsTags.item_id)
+            .join(TagModel, TagModel.id == ItemsTags.tag_id)
+            .where(TagModel.store_id == store_id)
+        ).all()
+
+        item_ids = array("q", sorted(item_ids))
+        positions = {item_id: position for position, item_id in enumerate(item_ids)}
+
+        tag_ids = {tag.id: tag.name for tag in tags}
+        # Bits are collected per tag and the int built once, or-ing them one by one copies the int every time
+        tag_bits = {tag.name: [] for tag in tags}
+        for tag_id, item_id in links:
+            position = positions.get(item_id)
+            if position is not None:
+                tag_bits[tag_ids[tag_id]].append(position)
+        tag_bitmaps = {name: self._bitmap(bits, len(item_ids)) for name, bits in tag_bits.items()}
+        return _StoreBitmaps(item_ids, tag_bitmaps, tag_ids, version)
+
+    # Int with the given bit positions set, built from a bytearray in one go
+    @staticmethod
+    def _bitmap(positions, size):
+        buffer = bytearray((size + 7) // 8)
+        for position in positions:
+            buffer[position >> 3] |= 1 << (position & 7)
+        return int.from_bytes(buffer, "little")
+
+    # Set bits back to item ids, the bit scan runs in C through the binary string
+    @staticmethod
+    def _ids(bitmap, item_ids):
+        if bitmap <= 0:
+            return []
+        bits = bin(bitmap)[:1:-1]
+        return [item_ids[match.start()] for match in re.finditer("1", bits)]
+
+    def _version_key(self, store_id):
+        return f"tagbitmaps:{store_id}:version"
+
+    def _version(self, store_id):
+        return self._redis_call(lambda: int(self.redis.get(self._version_key(store_id)) or 0))
+
+    def _bump_version(self, store_id):
+        return self._redis_call(lambda: self.redis.incr(self._version_key(store_id)))
+
+    # None when redis is not configured or down
+    def _redis_call(self, call):
+        if self.redis is None or time.time() < self._redis_down_until:
+            return None
+        try:
+            return call()
+        except RedisError:
+            self._redis_down_until = time.time() + REDIS_RETRY_SECONDS
+            return None
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import fakeredis
+import pytest
+import redis
+
+# The app modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Every redis.from_url() in the app connects to one in-memory server instead of a real redis
+@pytest.fixture
+def redis_server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setenv("REDIS_URL", "redis://localhost:6379")
+    monkeypatch.setattr(redis, "from_url", lambda *args, **kwargs: fakeredis.FakeRedis(server=server))
+    return server
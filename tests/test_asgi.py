@@ -0,0 +1,50 @@
+import asyncio
+import os
+import signal
+
+import asgi
+from db import db
+
+
+async def get(app, path):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "method": "GET", "path": path, "query_string": b"", "headers": [],
+        "client": ("127.0.0.1", 1234), "server": ("localhost", 80), "scheme": "http",
+        "http_version": "1.1", "root_path": "", "raw_path": path.encode(),
+    }
+    await app(scope, receive, send)
+    await app.engine.dispose()
+    return sent[0]["status"]
+
+
+def test_worker_recycles_itself_above_max_rss(tmp_path, monkeypatch, redis_server):
+    monkeypatch.setenv("WORKER_MAX_RSS_MB", "1")
+    app = asgi.create_asgi_app(f"sqlite:///{tmp_path}/data.db")
+    with app.flask_app.app_context():
+        db.create_all()
+
+    signals = []
+    monkeypatch.setattr(asgi.os, "kill", lambda pid, sig: signals.append((pid, sig)))
+    assert asyncio.run(get(app, "/store")) == 200
+    assert asyncio.run(get(app, "/store")) == 200
+    # Signalled once, the worker finishes its requests and exits on the first SIGTERM
+    assert signals == [(os.getpid(), signal.SIGTERM)]
+
+
+def test_max_rss_is_off_by_default(tmp_path, monkeypatch, redis_server):
+    app = asgi.create_asgi_app(f"sqlite:///{tmp_path}/data.db")
+    with app.flask_app.app_context():
+        db.create_all()
+
+    signals = []
+    monkeypatch.setattr(asgi.os, "kill", lambda pid, sig: signals.append((pid, sig)))
+    assert asyncio.run(get(app, "/store")) == 200
+    assert signals == []
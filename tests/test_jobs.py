@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta, timezone
+
+import fakeredis
+import pytest
+from rq import SimpleWorker
+from rq.job import JobStatus
+
+from jobs import JobQueues, worker_plan
+
+
+def double(value):
+    return value * 2
+
+
+def fail():
+    raise ValueError("failed on purpose")
+
+
+@pytest.fixture
+def connection():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def jobs(connection):
+    return JobQueues(connection, queue_names=["emails", "default"])
+
+
+def run_queued_jobs(jobs, connection):
+    SimpleWorker(list(jobs.queues.values()), connection=connection).work(burst=True)
+
+
+def test_enqueue_uses_the_named_queue(jobs):
+    job = jobs.enqueue(double, 2, queue="emails")
+    default_job = jobs.enqueue(double, 3)
+
+    assert job.origin == "emails"
+    assert default_job.origin == "default"
+    assert jobs.stats()["emails"]["enqueued"] == 1
+    assert jobs.stats()["emails"]["queued"] == 1
+
+
+def test_dedup_key_returns_the_pending_job(jobs, connection):
+    first = jobs.enqueue(double, 2, dedup_key="report:1")
+    second = jobs.enqueue(double, 2, dedup_key="report:1")
+
+    assert second.id == first.id
+    assert jobs.stats()["default"]["enqueued"] == 1
+    assert jobs.stats()["default"]["deduplicated"] == 1
+
+    # The key is released once the job has run, the next enqueue adds a new job
+    run_queued_jobs(jobs, connection)
+    assert first.get_status(refresh=True) == JobStatus.FINISHED
+    assert connection.get("jobs:dedup:report:1") is None
+    assert jobs.enqueue(double, 2, dedup_key="report:1").id != first.id
+
+
+def test_delayed_jobs_are_scheduled(jobs, connection):
+    job = jobs.enqueue(double, 2, delay=60)
+
+    assert job.get_status() == JobStatus.SCHEDULED
+    assert jobs.stats()["default"]["scheduled"] == 1
+    assert jobs.stats()["default"]["queued"] == 0
+    run_queued_jobs(jobs, connection)
+    assert job.get_status(refresh=True) == JobStatus.SCHEDULED
+
+
+def test_dedup_key_outlives_the_delay(jobs, connection):
+    delayed = jobs.enqueue(double, 2, dedup_key="delayed", delay=2 * 3600)
+    scheduled = jobs.enqueue(double, 2, dedup_key="at", at=datetime.now(timezone.utc) + timedelta(hours=3))
+
+    assert connection.ttl("jobs:dedup:delayed") > 2 * 3600 + jobs.dedup_ttl - 5
+    assert connection.ttl("jobs:dedup:at") > 3 * 3600 + jobs.dedup_ttl - 5
+    assert jobs.enqueue(double, 2, dedup_key="delayed", delay=2 * 3600).id == delayed.id
+    assert jobs.enqueue(double, 2, dedup_key="at").id == scheduled.id
+
+
+def test_metrics_count_outcomes_and_times(jobs, connection):
+    jobs.enqueue(double, 2)
+    jobs.enqueue(fail)
+    run_queued_jobs(jobs, connection)
+
+    stats = jobs.stats()["default"]
+    assert stats["succeeded"] == 1
+    assert stats["failed"] == 1
+    assert stats["failure_rate"] == 0.5
+    assert stats["failed_registry"] == 1
+    assert stats["wait_seconds"]["p50"] is not None
+    assert stats["run_seconds"]["avg"] is not None
+
+
+def test_worker_plan_gives_high_priority_queues_dedicated_workers():
+    assert worker_plan(["emails", "default"], {"emails": 1, "default": 2}) == [
+        ["emails", "default"],
+        ["default"],
+        ["default"],
+    ]
+
+
+def test_registration_succeeds_when_the_email_cannot_be_queued(tmp_path, monkeypatch, redis_server):
+    from redis.exceptions import ConnectionError as RedisConnectionError
+
+    from app import create_app
+    from db import db
+    from models import UserModel
+
+    app = create_app(f"sqlite:///{tmp_path}/data.db")
+    with app.app_context():
+        db.create_all()
+
+    def enqueue(*args, **kwargs):
+        raise RedisConnectionError("redis is down")
+
+    monkeypatch.setattr(app.jobs, "enqueue", enqueue)
+    response = app.test_client().post(
+        "/register", json={"username": "ada", "email": "ada@example.com", "password": "secret"}
+    )
+    assert response.status_code == 201
+    with app.app_context():
+        assert UserModel.query.filter_by(username="ada").count() == 1
+
+
+def test_registration_queues_one_email_per_user(tmp_path, redis_server):
+    from app import create_app
+    from db import db
+
+    app = create_app(f"sqlite:///{tmp_path}/data.db")
+    with app.app_context():
+        db.create_all()
+
+    client = app.test_client()
+    for name in ("ada", "grace"):
+        assert client.post("/register", json={"username": name, "email": f"{name}@example.com", "password": "secret"}).status_code == 201
+    assert app.jobs.queue("emails").count == 2
@@ -0,0 +1,21 @@
+from flask_jwt_extended import create_access_token
+
+from schemas import ProfilerStartSchema
+
+
+def test_invalid_route_regex_is_rejected(tmp_path, redis_server):
+    from app import create_app
+    app = create_app(f"sqlite:///{tmp_path}/data.db")
+    with app.app_context():
+        # The first user is the admin, see add_claims_to_jwt in app.py
+        token = create_access_token(identity=1, fresh=True)
+
+    response = app.test_client().post(
+        "/profiler", json={"seconds": 1, "route": "^/store/("}, headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response.status_code == 422
+    assert "route" in response.get_json()["errors"]["json"]
+
+
+def test_valid_route_regex_is_loaded():
+    assert ProfilerStartSchema().load({"seconds": 1, "route": "^/store/[0-9]+"})["route"] == "^/store/[0-9]+"
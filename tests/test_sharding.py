@@ -0,0 +1,205 @@
+import sqlite3
+import threading
+
+import fakeredis
+import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+
+import reads
+from db import db
+from models import StoreModel, ItemModel, TagModel
+from sharding import ShardingError
+
+SHARDS = 3
+
+
+# Three local sqlite files, the main database is shard 0
+@pytest.fixture
+def app(tmp_path, monkeypatch, redis_server):
+    monkeypatch.setenv("SHARD_DATABASE_URLS", f"sqlite:///{tmp_path}/shard1.db,sqlite:///{tmp_path}/shard2.db")
+    # init_sharding replaces db.session and db.init_app adds a metadata per shard, the other tests need them back
+    monkeypatch.setattr(db, "session", db.session)
+    monkeypatch.setattr(db, "metadatas", dict(db.metadatas))
+
+    from app import create_app
+    app = create_app(f"sqlite:///{tmp_path}/shard0.db")
+    with app.app_context():
+        for engine in db.engines.values():
+            db.metadata.create_all(engine)
+    return app
+
+
+def ids(tmp_path, shard, table):
+    with sqlite3.connect(tmp_path / f"shard{shard}.db") as connection:
+        return sorted(row[0] for row in connection.execute(f"SELECT id FROM {table}"))
+
+
+def fakeredis_keys(server, pattern):
+    return fakeredis.FakeRedis(server=server).scan_iter(pattern)
+
+
+# Counts the max(id) queries used to seed the id counters
+def count_max_queries(app):
+    counter = {"max": 0}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if "max(" in statement:
+            counter["max"] += 1
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    return counter
+
+
+def test_rows_are_placed_on_their_store_shard(app, tmp_path):
+    client = app.test_client()
+    store_ids = [client.post("/store", json={"name": f"store-{n}"}).get_json()["id"] for n in range(SHARDS)]
+    assert store_ids == [1, 2, 3]
+
+    with app.app_context():
+        for store_id in store_ids:
+            db.session.add(ItemModel(name=f"item-{store_id}", price=1.0, store_id=store_id))
+            db.session.add(TagModel(name=f"tag-{store_id}", store_id=store_id))
+            db.session.commit()
+
+    for shard in range(SHARDS):
+        assert ids(tmp_path, shard, "stores") == [store_id for store_id in store_ids if store_id % SHARDS == shard]
+        assert len(ids(tmp_path, shard, "items")) == 1
+        assert all(item_id % SHARDS == shard for item_id in ids(tmp_path, shard, "items"))
+        assert all(tag_id % SHARDS == shard for tag_id in ids(tmp_path, shard, "tags"))
+
+
+def test_concurrent_inserts_get_distinct_ids(app, tmp_path):
+    client = app.test_client()
+    client.post("/store", json={"name": "store"})
+    barrier = threading.Barrier(8)
+    statuses = []
+
+    def create_store(n):
+        barrier.wait()
+        statuses.append(app.test_client().post("/store", json={"name": f"store-{n}"}).status_code)
+
+    def create_item(n):
+        with app.app_context():
+            barrier.wait()
+            db.session.add(ItemModel(name=f"item-{n}", price=1.0, store_id=1))
+            db.session.commit()
+
+    for target in (create_store, create_item):
+        threads = [threading.Thread(target=target, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert statuses == [201] * 8
+    assert sum(len(ids(tmp_path, shard, "stores")) for shard in range(SHARDS)) == 9
+    assert ids(tmp_path, 1, "items") == [1 + SHARDS * n for n in range(8)]
+
+
+def test_id_counters_are_seeded_once(app):
+    max_queries = count_max_queries(app)
+    client = app.test_client()
+    client.post("/store", json={"name": "first"})
+    # One max() per shard to seed the store counter
+    assert max_queries["max"] == SHARDS
+
+    client.post("/store", json={"name": "second"})
+    client.post("/store", json={"name": "third"})
+    assert max_queries["max"] == SHARDS
+
+
+def test_reset_ids_reseeds_after_explicit_ids(app):
+    with app.app_context():
+        db.session.add(StoreModel(name="store"))
+        db.session.commit()
+        db.session.add(ItemModel(name="first", price=1.0, store_id=1))
+        db.session.commit()
+        # Inserted with an id the counter did not hand out, e.g. by an import
+        db.session.add(ItemModel(id=10, name="imported", price=1.0, store_id=1))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["shards", "reset-ids"])
+    assert result.output == "Reset 2 id counters.\n"
+
+    with app.app_context():
+        item = ItemModel(name="after reset", price=1.0, store_id=1)
+        db.session.add(item)
+        db.session.commit()
+        assert item.id == 13
+
+
+def test_allocation_errors_are_handled_by_the_resources(app, monkeypatch):
+    assert issubclass(ShardingError, SQLAlchemyError)
+
+    def unavailable(*args, **kwargs):
+        raise RedisConnectionError("redis is down")
+
+    monkeypatch.setattr(app.id_allocator, "_incr", unavailable)
+    response = app.test_client().post("/store", json={"name": "store"})
+    assert response.status_code == 500
+    assert response.get_json()["message"] == "An error occurred creating the store."
+
+
+def test_create_all_reports_every_shard(app):
+    result = app.test_cli_runner().invoke(args=["shards", "create-all"])
+    assert result.output.count("Created tables on") == SHARDS
+
+
+def test_list_endpoints_are_sorted_across_shards(app):
+    client = app.test_client()
+    for n in range(6):
+        client.post("/store", json={"name": f"store-{n}"})
+    with app.app_context():
+        for store_id in range(1, 7):
+            db.session.add(ItemModel(name=f"item-{store_id}", price=1.0, store_id=store_id))
+            db.session.commit()
+
+    with app.app_context():
+        store_ids = [store.id for store in reads.stores()]
+        item_ids = [item.id for item in reads.items()]
+        assert store_ids == sorted(store_ids) == [1, 2, 3, 4, 5, 6]
+        assert item_ids == sorted(item_ids)
+        assert [item.id for item in reads.items(item_ids[::-1])] == item_ids
+
+
+def test_store_names_are_unique_across_shards(app):
+    client = app.test_client()
+    statuses = [client.post("/store", json={"name": "same"}).status_code for _ in range(SHARDS)]
+    assert statuses == [201, 400, 400]
+    assert [store["name"] for store in client.get("/store").get_json()] == ["same"]
+
+
+def test_tag_names_are_unique_across_shards(app):
+    client = app.test_client()
+    client.post("/store", json={"name": "first"})
+    client.post("/store", json={"name": "second"})
+    assert client.post("/store/1/tag", json={"name": "organic"}).status_code == 201
+    # The unique index on tags.name fails this insert without sharding, it must fail across shards too
+    assert client.post("/store/2/tag", json={"name": "organic"}).status_code == 500
+    assert client.get("/store/2/tag").get_json() == []
+
+
+def test_names_are_released_after_deletes_and_failed_inserts(app, redis_server):
+    client = app.test_client()
+    assert client.post("/store", json={"name": "reused"}).status_code == 201
+    assert client.delete("/store/1").status_code == 200
+    assert client.post("/store", json={"name": "reused"}).status_code == 201
+    assert client.post("/store", json={"name": "reused"}).status_code == 400
+    assert client.post("/store", json={"name": "other"}).status_code == 201
+    # Nothing stays claimed once the transactions are over
+    assert list(fakeredis_keys(redis_server, "shards:names:*")) == []
+
+
+def test_main_database_only_tools_refuse_sharding(app, tmp_path):
+    result = app.test_cli_runner().invoke(args=["online", "seed", "--stores", "3", "--items", "9", "--tags", "3"])
+    assert result.exit_code != 0
+    assert "does not support sharding" in result.output
+    assert ids(tmp_path, 1, "stores") == []
+
+    from asgi import create_asgi_app
+    with pytest.raises(RuntimeError, match="does not support sharding"):
+        create_asgi_app(f"sqlite:///{tmp_path}/shard0.db")
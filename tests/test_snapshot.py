@@ -0,0 +1,36 @@
+import os
+import time
+
+import pytest
+from sqlalchemy import event
+
+from db import db
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch, redis_server):
+    monkeypatch.setenv("CATALOG_SNAPSHOT", str(tmp_path / "catalog.snap"))
+    monkeypatch.setenv("CATALOG_SNAPSHOT_MAX_DELAY", "0.5")
+    from app import create_app
+    app = create_app(f"sqlite:///{tmp_path}/data.db")
+    with app.app_context():
+        db.create_all()
+    yield app
+    # The snapshot listens on the shared db.session, later apps must not rebuild this one
+    event.remove(db.session, "after_flush", app.catalog._after_flush)
+    event.remove(db.session, "after_commit", app.catalog._after_commit)
+
+
+def test_rebuild_runs_while_writes_keep_coming(app):
+    client = app.test_client()
+    client.post("/store", json={"name": "first"})
+    assert len(client.get("/store").get_json()) == 1
+    built_at = os.stat(app.catalog.path).st_mtime
+
+    # Each write comes before the 0.5 s debounce of the previous one has run out
+    for n in range(10):
+        client.post("/store", json={"name": f"store-{n}"})
+        time.sleep(0.2)
+
+    assert os.stat(app.catalog.path).st_mtime != built_at
+    assert len(client.get("/store").get_json()) > 1
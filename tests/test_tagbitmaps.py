@@ -0,0 +1,72 @@
+import pytest
+
+from db import db
+from models import StoreModel, ItemModel, TagModel
+from tagbitmaps import TagBitmaps
+
+STORES = 3
+
+
+# Items of the stores interleaved, like "flask online seed" lays them out: store n has ids n, n + 3, n + 6, ...
+@pytest.fixture
+def app(tmp_path, redis_server):
+    from app import create_app
+    app = create_app(f"sqlite:///{tmp_path}/data.db")
+    with app.app_context():
+        db.create_all()
+        stores = [StoreModel(name=f"store-{n}") for n in range(STORES)]
+        db.session.add_all(stores)
+        db.session.flush()
+        tags = {name: TagModel(name=name, store_id=stores[0].id) for name in ("organic", "sale", "discontinued")}
+        db.session.add_all(tags.values())
+        for n in range(30):
+            item = ItemModel(name=f"item-{n}", price=1.0, store_id=stores[n % STORES].id)
+            if item.store_id == stores[0].id:
+                item.tags = [tag for name, tag in tags.items() if n % {"organic": 2, "sale": 3, "discontinued": 4}[name] == 0]
+            db.session.add(item)
+        db.session.commit()
+    return app
+
+
+def test_filter_matches_the_links(app):
+    bitmaps = TagBitmaps()
+    with app.app_context():
+        # Store 1 holds items 1, 4, 7, ..., 28 (item-0, item-3, ...), n is the item id - 1
+        assert bitmaps.filter(1) == list(range(1, 31, 3))
+        assert bitmaps.filter(1, ["organic"]) == [1, 7, 13, 19, 25]
+        assert bitmaps.filter(1, ["organic", "sale"]) == [1, 7, 13, 19, 25]
+        assert bitmaps.filter(1, ["organic"], ["discontinued"]) == [7, 19]
+        assert bitmaps.filter(1, ["unknown"]) == []
+        assert bitmaps.filter(1, exclude=["unknown"]) == list(range(1, 31, 3))
+
+
+def test_bitmaps_grow_with_the_store_not_the_id_range(app):
+    bitmaps = TagBitmaps()
+    with app.app_context():
+        bitmaps.filter(1)
+        store = bitmaps._stores[1]
+        # 10 items in the store, spread over ids 1..28
+        assert store.items.bit_length() == 10
+        assert max(bitmap.bit_length() for bitmap in store.tags.values()) <= 10
+
+
+def test_link_and_unlink_patch_the_bitmaps(app):
+    bitmaps = TagBitmaps()
+    with app.app_context():
+        bitmaps.filter(1)
+        sale = TagModel.query.filter_by(name="sale").one()
+        bitmaps.link(1, sale.id, 4)
+        assert 4 in bitmaps.filter(1, ["sale"])
+        bitmaps.unlink(1, sale.id, 4)
+        assert 4 not in bitmaps.filter(1, ["sale"])
+        # An item the bitmaps do not know (added since they were built) makes them rebuild
+        bitmaps.link(1, sale.id, 99)
+        assert 1 not in bitmaps._stores
+
+
+def test_least_recently_queried_stores_are_dropped(app):
+    bitmaps = TagBitmaps(max_stores=2)
+    with app.app_context():
+        for store_id in (1, 2, 1, 3):
+            bitmaps.filter(store_id)
+    assert list(bitmaps._stores) == [1, 3]